@@ -6,26 +6,25 @@ if __name__ == '__main__':
         print()
 
 def main():
-    fn = '/opt/Xilinx/14.7/ISE_DS/ISE/xc9500xl/data/xc9572xl_vq64.bsd'
+    parser = argparse.ArgumentParser()
+    add_openocd_args(parser)
+    add_bsdl_args(parser)
+    args = parser.parse_args()
 
-    ocd = OpenOCD()
-    bs = BS(ocd, 'xc.tap', fn)
+    ocd = open_openocd(args)
+    bs = BS(ocd, 'xc.tap', args.bsdl, package = args.package)
 
     if 0:
         pprint(bs.bsdl.cells)
         pprint(bs.bsdl.portmaps)
         pprint(bs.bsdl.pinmaps)
 
-    assert len(bs.bsdl.pinmaps) == 1
-    package = list(bs.bsdl.pinmaps.keys())[0]
-    pinmap = bs.bsdl.pinmaps[package]
-    portmap = bs.bsdl.portmaps[package]
+    dev = bs.device
+    rx = dev.port('18')
+    tx = dev.port('19')
 
-    rx_cell = bs.bsdl.cells[pinmap['18']]
-    tx_cell = bs.bsdl.cells[pinmap['19']]
-
-    pprint(rx_cell)
-    pprint(tx_cell)
+    pprint(bs.bsdl.cells[dev.ports[rx]])
+    pprint(bs.bsdl.cells[dev.ports[tx]])
 
     if 1:
         t0 = 0
@@ -37,17 +36,19 @@ def main():
                 sys.stdout.write("\x1b[H\x1b[2J")
                 t0 = t
                 # the OE bit is cleared when sampling, strange
-                wdata |= 1 << tx_cell['oe']
-                wdata ^= 1 << tx_cell['output']
+                wdata |= dev.control_mask[tx]
+                wdata ^= dev.output_mask[tx]
 
             sys.stdout.write("\x1b[H")
 
             rdata = bs.extest(wdata)
-            for k, v in sorted(bs.bsdl.cells.items()):
-                s = "%-10s %4s" % (k, ','.join(portmap[k]))
-                for f in [ 'input', 'output', 'oe', 'oe_disable' ]:
-                    if f in v:
-                        num = v[f]
+            for i, k in enumerate(dev.ports):
+                s = "%-10s %4s" % (k, ','.join(dev.port_pins[i]))
+                for f, cells in [ ('input', dev.input),
+                                  ('output', dev.output),
+                                  ('oe', dev.control) ]:
+                    num = cells[i]
+                    if num >= 0:
                         s += "  %s %4s %4s" % (f, num, (rdata >> num) & 1)
                 print(s)
             t = time.time()
@@ -0,0 +1,156 @@
+#! /usr/bin/python3
+"""Benchmark the BSDL parser on a corpus of BSDL files.
+
+For every file this measures the time for the full parser, for
+asjson(), for building the ParsedBsdl tables from the JSON and for the
+fast extractor, and the peak memory used by parse and asjson.  Every
+run is appended to a history file and compared with the previous run
+on the same file contents, so parser changes can be judged against a
+baseline.
+"""
+
+from emu2000_lib import *
+
+import platform
+import tracemalloc
+
+if __name__ == '__main__':
+    if not sys.argv[0]:
+        print()
+
+COLUMNS = [ 'parse', 'asjson', 'tables', 'fast', 'peak_kb' ]
+
+def best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def bench(fn, repeat = 3, memory = True):
+    with open(fn, 'rb') as f:
+        data = f.read()
+    text = data.decode('latin-1')
+
+    def parse():
+        parser = bsdl_parser_class()()
+        return parser.parse_text(text, 'bsdl_description',
+                                 parseinfo = False)
+
+    result = {
+        'size' : len(data),
+        'sha256' : hashlib.sha256(data).hexdigest(),
+        }
+
+    result['parse'], ast = best_time(parse, repeat)
+    result['asjson'], desc = best_time(ast.asjson, repeat)
+
+    def tables():
+        parsed = ParsedBsdl(fn, cache = False, fast = False)
+        parsed.__dict__['json'] = desc
+        return parsed.get_tables()
+
+    result['tables'], t = best_time(tables, repeat)
+    result['fast'], t = best_time(
+        lambda: ParsedBsdl(fn, cache = False, fast = True).get_tables(), repeat)
+
+    if memory:
+        ast = desc = None
+        tracemalloc.start()
+        ast = parse()
+        desc = ast.asjson()
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+
+    return result
+
+def previous_results(history):
+    """Latest result for each file contents in the history."""
+
+    previous = {}
+    if not os.path.exists(history):
+        return previous
+    with open(history) as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            for fn, result in run['results'].items():
+                previous[result['sha256']] = result
+    return previous
+
+def format_value(name, v):
+    if v is None:
+        return "%9s" % '-'
+    if name == 'peak_kb':
+        return "%9.0f" % v
+    return "%9.4f" % v
+
+def format_change(name, v, old):
+    if v is None or old is None or not old.get(name):
+        return "%7s" % ''
+    return "%+6.0f%%" % ((v - old[name]) / old[name] * 100)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs = '+',
+                        help = "BSDL files or directories")
+    parser.add_argument('-r', '--repeat', type = int, default = 3,
+                        help = "runs per measurement, the best time is used")
+    parser.add_argument('--no-memory', action = 'store_true',
+                        help = "do not measure peak memory (it is slow)")
+    parser.add_argument('--history', default = os.path.join(
+        CACHE_DIR, 'bsdl_bench.jsonl'),
+                        help = "file with the results of earlier runs")
+    parser.add_argument('--no-history', action = 'store_true',
+                        help = "do not add this run to the history")
+    args = parser.parse_args()
+
+    previous = previous_results(args.history)
+
+    print("%9s" % 'size' + ''.join([ "%9s %7s" % (c, '') for c in COLUMNS ]))
+
+    results = {}
+    totals = {}
+    for fn in find_bsdl_files(args.paths):
+        try:
+            result = bench(fn, args.repeat, not args.no_memory)
+        except Exception as e:
+            print("%s: %s" % (fn, e))
+            continue
+        results[fn] = result
+
+        old = previous.get(result['sha256'])
+        s = "%9u" % result['size']
+        for c in COLUMNS:
+            v = result.get(c)
+            s += format_value(c, v) + ' ' + format_change(c, v, old)
+            if v is not None:
+                totals[c] = totals.get(c, 0) + v
+        print(s + ' ' + fn)
+
+    if not results:
+        return
+
+    print()
+    print("total %u files: %s" % (len(results), ', '.join(
+        [ "%s %.4f" % (c, totals[c]) for c in COLUMNS
+          if c in totals and c != 'peak_kb' ])))
+    print("change is relative to the previous run on the same file")
+
+    if not args.no_history:
+        d = os.path.dirname(args.history)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({ 'time' : time.time(),
+                                 'parser' : bsdl_parser_version(),
+                                 'python' : platform.python_version(),
+                                 'results' : results }) + '\n')
+
+if __name__ == '__main__':
+    main()
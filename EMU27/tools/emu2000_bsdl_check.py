@@ -0,0 +1,70 @@
+#! /usr/bin/python3
+"""Compare the fast BSDL extractor with the full parser.
+
+Give it BSDL files or directories with BSDL files, for example the
+data directory of a Xilinx ISE installation.  Every file is parsed
+both ways and the tables ParsedBsdl builds are compared.
+"""
+
+from emu2000_lib import *
+
+if __name__ == '__main__':
+    if not sys.argv[0]:
+        print()
+
+def check(fn):
+    t0 = time.perf_counter()
+    try:
+        full = ParsedBsdl(fn, cache = False, fast = False).get_tables()
+    except Exception as e:
+        return 'failed, full parser: %s' % e, 0, 0
+    t1 = time.perf_counter()
+    parsed = ParsedBsdl(fn, cache = False, fast = True)
+    fast = parsed.get_tables()
+    t2 = time.perf_counter()
+
+    if parsed.extractor != 'fast':
+        status = 'fallback'
+    else:
+        diffs = [ name for name in ParsedBsdl.TABLES
+                  if fast[name] != full[name] ]
+        if diffs:
+            status = 'MISMATCH in %s' % ', '.join(diffs)
+        else:
+            status = 'ok'
+
+    return status, t1 - t0, t2 - t1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs = '+',
+                        help = "BSDL files or directories")
+    args = parser.parse_args()
+
+    counts = {}
+    total_full = 0
+    total_fast = 0
+    for fn in find_bsdl_files(args.paths):
+        status, t_full, t_fast = check(fn)
+        key = status.split()[0].rstrip(',')
+        counts[key] = counts.get(key, 0) + 1
+        total_full += t_full
+        total_fast += t_fast
+        if t_fast:
+            print("%8.3f %8.3f %7.1fx  %-10s %s" % (
+                t_full, t_fast, t_full / t_fast, status, fn))
+        else:
+            print("%8s %8s %8s  %-10s %s" % ('', '', '', status, fn))
+
+    print()
+    for key, n in sorted(counts.items()):
+        print("%-10s %u" % (key, n))
+    if total_fast:
+        print("full %.3f s, fast %.3f s, %.1fx" % (
+            total_full, total_fast, total_full / total_fast))
+
+    if 'MISMATCH' in counts:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
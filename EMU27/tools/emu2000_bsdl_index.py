@@ -0,0 +1,52 @@
+#! /usr/bin/python3
+"""Index a library of BSDL files by IDCODE.
+
+Walks the given directories (default $EMU2000_BSDL_PATH or the Xilinx
+ISE installation), parses new or changed files in a process pool and
+updates the index which BS uses to find the BSDL file for a device.
+"""
+
+from emu2000_lib import *
+
+if __name__ == '__main__':
+    if not sys.argv[0]:
+        print()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs = '*',
+                        help = "BSDL files or directories, default %s" % BSDL_PATH)
+    parser.add_argument('-j', '--jobs', type = int,
+                        help = "number of worker processes")
+    parser.add_argument('--index',
+                        help = "index file, default ~/.cache/emu2000/bsdl_index.json")
+    parser.add_argument('--rebuild', action = 'store_true',
+                        help = "parse all files again")
+    parser.add_argument('--lookup', type = lambda s: int(s, 0), action = 'append',
+                        help = "show the files matching an IDCODE")
+    parser.add_argument('-v', '--verbose', action = 'count', default = 1)
+    args = parser.parse_args()
+
+    index = BsdlIndex(args.index)
+    if args.rebuild:
+        index.files = {}
+
+    if args.paths or not args.lookup:
+        t0 = time.perf_counter()
+        n = index.update(args.paths or None, args.jobs, args.verbose)
+        t = time.perf_counter() - t0
+        errors = len([ e for e in index.files.values() if 'error' in e ])
+        print("%u files indexed, %u parsed, %u errors, %.3f s" % (
+            len(index.files), n, errors, t))
+
+    for idcode in args.lookup or []:
+        matches = index.lookup(idcode)
+        if not matches:
+            print("%08x not found" % idcode)
+        for m in matches:
+            print("%08x/%08x %-16s %-12s irlen %u %s" % (
+                m['idcode'], m['idmask'], m['name'],
+                ','.join(m['packages']), m['irlen'], m['fn']))
+
+if __name__ == '__main__':
+    main()
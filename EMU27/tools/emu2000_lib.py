@@ -2,12 +2,21 @@
 import sys
 import os
 import socket
+import select
+import subprocess
 import time
+import re
 import json
+import gzip
+import argparse
+import asyncio
+import collections
+import random
+import math
+import hashlib
+import concurrent.futures
 from pprint import pprint
 
-import bsdl
-
 if __name__ == '__main__':
     if not sys.argv[0]:
         print()
@@ -42,91 +51,1002 @@ class lazy_value(object):
         obj.__dict__[self.name] = value
         return value
 
+# Per user cache for calibrated speeds and parsed BSDL files
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'emu2000')
+
+def load_json(fn, default = None):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def save_json(fn, data):
+    """Write a JSON file atomically so readers never see half of it."""
+
+    d = os.path.dirname(fn)
+    if d:
+        os.makedirs(d, exist_ok = True)
+    tmp = '%s.%u.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent = 4)
+    os.replace(tmp, fn)
+
+class Stats(object):
+    """Count, bytes, total time and a latency histogram per kind.
+
+    Bucket i of a histogram counts the events which took less than
+    2**i microseconds but at least 2**(i-1) microseconds.
+    """
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.kinds = {}
+
+    def add(self, kind, nbytes, latency):
+        d = self.kinds.get(kind)
+        if d is None:
+            d = self.kinds[kind] = {
+                'count' : 0,
+                'bytes' : 0,
+                'time' : 0.0,
+                'min' : latency,
+                'max' : latency,
+                'histogram' : [ 0 ] * self.BUCKETS,
+            }
+        d['count'] += 1
+        d['bytes'] += nbytes
+        d['time'] += latency
+        d['min'] = min(d['min'], latency)
+        d['max'] = max(d['max'], latency)
+        i = min(int(latency * 1e6).bit_length(), self.BUCKETS - 1)
+        d['histogram'][i] += 1
+
+    def timer(self, kind, nbytes = 0):
+        return StatsTimer(self, kind, nbytes)
+
+    def clear(self):
+        self.kinds = {}
+
+    def as_dict(self):
+        r = {}
+        for kind, d in sorted(self.kinds.items()):
+            d = dict(d)
+            d['mean'] = d['time'] / d['count']
+            d['histogram'] = dict([ ('<%uus' % (1 << i), n)
+                                    for i, n in enumerate(d['histogram'])
+                                    if n ])
+            r[kind] = d
+        return r
+
+    def report(self):
+        s = ''
+        for kind, d in sorted(self.kinds.items()):
+            s += "%-14s %8u times %10u bytes %9.3f s %9.1f us each\n" % (
+                kind, d['count'], d['bytes'], d['time'],
+                d['time'] / d['count'] * 1e6)
+        return s
+
+class StatsTimer(object):
+    def __init__(self, stats, kind, nbytes):
+        self.stats = stats
+        self.kind = kind
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.t0
+        self.stats.add(self.kind, self.nbytes, self.elapsed)
+
+class TcpTransport(object):
+    """Talk to an openocd daemon over its Tcl server TCP port."""
+
+    def __init__(self, host = '127.0.0.1', port = 6666, verbose = 1):
+        if verbose:
+            print("connecting to %s:%s" % (host, port))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((host, port))
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def sendall(self, buf):
+        self.sock.sendall(buf)
+
+    def recv_into(self, view):
+        return self.sock.recv_into(view)
+
+    def close(self):
+        self.sock.close()
+
+class PipeTransport(object):
+    """Start openocd with the Tcl server on stdin/stdout.
+
+    openocd is started with "tcl_port pipe" and the given
+    configuration file and is stopped when the transport is closed.
+    The log output from openocd still goes to stderr.  openocd can be
+    a list for a command with arguments, such as a script standing in
+    for openocd.
+    """
+
+    def __init__(self, cfg = 'openocd.cfg', openocd = 'openocd',
+                 args = (), verbose = 1):
+        cfg = os.path.abspath(cfg)
+        if isinstance(openocd, str):
+            openocd = [ openocd ]
+        cmd = list(openocd) + [
+                '-s', os.path.dirname(cfg),
+                '-c', 'tcl_port pipe',
+                '-c', 'gdb_port disabled',
+                '-c', 'telnet_port disabled',
+                '-f', cfg ] + list(args)
+        if verbose:
+            print("starting %s" % ' '.join(cmd))
+        self.proc = subprocess.Popen(cmd, bufsize = 0,
+                                     stdin = subprocess.PIPE,
+                                     stdout = subprocess.PIPE)
+        self.wfd = self.proc.stdin.fileno()
+        self.rfd = self.proc.stdout.fileno()
+        os.set_blocking(self.wfd, False)
+        self.timeout = None
+
+        # Replies read while writing, openocd stops reading commands
+        # when nobody reads its replies and the pipe is full
+        self.rbuf = bytearray()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, buf):
+        view = memoryview(buf)
+        while view:
+            r, w, x = select.select([ self.rfd ], [ self.wfd ], [], self.timeout)
+            if not r and not w:
+                raise TimeoutError("timeout writing to openocd")
+            if r:
+                data = os.read(self.rfd, 65536)
+                if not data:
+                    raise EOFError("openocd closed its output")
+                self.rbuf += data
+            if w:
+                try:
+                    view = view[os.write(self.wfd, view):]
+                except BlockingIOError:
+                    pass
+
+    def recv_into(self, view):
+        if self.rbuf:
+            n = min(len(view), len(self.rbuf))
+            view[:n] = self.rbuf[:n]
+            del self.rbuf[:n]
+            return n
+        r, w, x = select.select([ self.rfd ], [], [], self.timeout)
+        if not r:
+            raise TimeoutError("timeout reading from openocd")
+        return os.readv(self.rfd, [ view ])
+
+    def close(self):
+        # openocd exits when its end of the pipe is closed
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(timeout = 5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+
+class Recorder(object):
+    """Write command/reply pairs to a gzipped file with one JSON list
+    [time sent, time replied, command, reply] per line.  Times are in
+    seconds from the start of the recording.  A line with a JSON
+    object instead holds values from note() which a replay needs, such
+    as the adapter speed."""
+
+    VERSION = 2
+
+    def __init__(self, fn):
+        self.f = gzip.open(fn, 'wt')
+        self.t0 = time.perf_counter()
+        self.f.write(json.dumps({ 'emu2000_record' : self.VERSION,
+                                  'time' : time.time() }) + '\n')
+
+    def add(self, t_sent, t_reply, cmd, reply):
+        self.f.write(json.dumps([ round(t_sent - self.t0, 6),
+                                  round(t_reply - self.t0, 6),
+                                  cmd, reply ]) + '\n')
+
+    def note(self, values):
+        self.f.write(json.dumps(values) + '\n')
+
+    def close(self):
+        self.f.close()
+
+class ReplayTransport(object):
+    """Serve the replies from a recording made with OpenOCD.record.
+
+    The commands sent must match the recorded ones, in order.  With
+    realtime a reply is not available until the recorded latency has
+    passed, otherwise everything is answered at once.  The values
+    noted in the recording are in header, the first one of each name.
+    """
+
+    def __init__(self, fn, realtime = False, verbose = 1):
+        if verbose:
+            print("replaying %s" % fn)
+        with gzip.open(fn, 'rt') as f:
+            self.header = json.loads(f.readline())
+            assert self.header.get('emu2000_record') in (1, Recorder.VERSION)
+            self.records = collections.deque()
+            for line in f:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    for name, value in record.items():
+                        self.header.setdefault(name, value)
+                else:
+                    self.records.append(record)
+        self.realtime = realtime
+
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+
+        # (time, size) for replies which are not due yet
+        self.due = collections.deque()
+
+        self.count = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, buf):
+        self.inbuf += buf
+        while True:
+            i = self.inbuf.find(OpenOCD.EOM)
+            if i == -1:
+                break
+            cmd = self.inbuf[:i].decode('ascii')
+            del self.inbuf[:i+1]
+
+            if not self.records:
+                raise ValueError("replay: no more recorded commands, got %s" % repr(cmd))
+            t_sent, t_reply, recorded, reply = self.records.popleft()
+            if cmd != recorded:
+                raise ValueError("replay: command %u is %s, recorded %s" % (
+                    self.count, repr(cmd), repr(recorded)))
+            self.count += 1
+
+            reply = reply.encode('ascii') + OpenOCD.EOM
+            if self.realtime:
+                self.due.append((time.perf_counter() + t_reply - t_sent, reply))
+            else:
+                self.outbuf += reply
+
+    def recv_into(self, view):
+        if not self.outbuf and self.due:
+            t, reply = self.due.popleft()
+            delay = t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.outbuf += reply
+
+        n = min(len(view), len(self.outbuf))
+        view[:n] = self.outbuf[:n]
+        del self.outbuf[:n]
+        return n
+
+    def close(self):
+        pass
+
 class OpenOCD(object):
     EOM = b'\x1a'
 
-    def __init__(self, host = '127.0.0.1', port = 6666, verbose = 1):
+    # Commands which get their own entry in stats, everything else is
+    # counted as 'other'
+    KINDS = [ 'irscan', 'drscan', 'emu2000_scan' ]
+
+    def __init__(self, host = '127.0.0.1', port = 6666, verbose = 1,
+                 transport = None):
         self.host = host
         self.port = port
-        self.bufsize = 3276
+        self.bufsize = 65536
         self.timeout = 30
         self.verbose = verbose
 
-        if self.verbose:
-            print("connecting to %s:%s" % (port, host))
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        # Maximum number of commands and of bytes written ahead of
+        # their replies by cmd_many.  A reply is taken to be about as
+        # long as its command, which is true for the scans where it
+        # matters.  Keeps the socket or pipe buffers on both sides
+        # from filling up with replies nobody is reading yet.
+        self.depth = 64
+        self.window = 16384
+
+        # Receive buffer.  rbuf[rstart:rend] has been received but not
+        # returned yet, with pipelined commands this can hold several
+        # replies.  Data is received straight into the buffer through
+        # rview and the buffer only grows if a single reply does not
+        # fit.
+        self.rbuf = bytearray(self.bufsize)
+        self.rview = memoryview(self.rbuf)
+        self.rstart = 0
+        self.rend = 0
+
+        # Time, kind and size of the commands waiting for a reply
+        self.inflight = collections.deque()
+        self.stats = Stats()
+
+        self.recorder = None
+
+        # Number of commands sent, lets a user of this connection
+        # notice that someone else has sent commands in between
+        self.serial = 0
+
+        if transport is None:
+            transport = TcpTransport(host, port, verbose = verbose)
+        self.transport = transport
+
+    @classmethod
+    def spawn(cls, cfg = 'openocd.cfg', openocd = 'openocd', verbose = 1):
+        """Start a private openocd and talk to it over a pipe."""
+
+        return cls(verbose = verbose,
+                   transport = PipeTransport(cfg, openocd, verbose = verbose))
+
+    def record(self, fn):
+        """Record all commands and replies to a file for ReplayTransport."""
+
+        self.recorder = Recorder(fn)
+
+    def note(self, **values):
+        """Save values in the recording for a replay of it."""
+
+        if self.recorder:
+            self.recorder.note(values)
+
+    def recorded(self, name, default = None):
+        """A value noted in the session which is being replayed."""
+
+        return getattr(self.transport, 'header', {}).get(name, default)
+
+    def close(self):
+        self.transport.close()
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
 
     def cmd(self, s, timeout = None):
         self.send(s, timeout = timeout)
         return self.recv(timeout = timeout)
 
-    def send(self, s, timeout = None):
+    def cmd_many(self, cmds, timeout = None):
+        """Send a list of commands and return a list of the replies.
+
+        The commands are written back to back in chunks of at most
+        self.depth commands and self.window bytes of commands and
+        replies, the replies for one chunk are read while the next
+        chunk is already on its way, so the cost is about one round
+        trip per chunk instead of one per command.
+        """
+
+        chunks = []
+        size = 0
+        for s in cmds:
+            n = 2 * (len(s) + 1)
+            if (not chunks or len(chunks[-1]) >= self.depth or
+                (chunks[-1] and size + n > self.window)):
+                chunks.append([])
+                size = 0
+            chunks[-1].append(s)
+            size += n
+
+        replies = []
+        pending = 0
+        for chunk in chunks:
+            self.send_many(chunk, timeout = timeout)
+            for j in range(pending):
+                replies.append(self.recv(timeout = timeout))
+            pending = len(chunk)
+        for j in range(pending):
+            replies.append(self.recv(timeout = timeout))
+        return replies
+
+    def encode(self, s):
         if self.verbose:
             print("> %s" % s)
         if not isinstance(s, bytes):
             s = s.encode('ascii')
+        return s + self.EOM
+
+    def send(self, s, timeout = None):
+        self.send_many([ s ], timeout = timeout)
+
+    def send_many(self, cmds, timeout = None):
+        bufs = [ self.encode(s) for s in cmds ]
         if timeout is None:
             timeout = self.timeout
-        self.sock.settimeout(timeout)
-        self.sock.send(s + self.EOM)
+        self.transport.settimeout(timeout)
+        self.transport.sendall(b''.join(bufs))
+        self.serial += len(bufs)
+
+        t = time.perf_counter()
+        for buf in bufs:
+            kind = buf.split(None, 1)[0].decode('ascii')
+            if kind not in self.KINDS:
+                kind = 'other'
+            self.inflight.append((t, kind, buf))
 
     def recv(self, timeout = None):
         if timeout is None:
             timeout = self.timeout
-        self.sock.settimeout(timeout)
-        buf = bytearray()
-        while True:
-            buf += self.sock.recv(self.bufsize)
-            i = buf.find(self.EOM)
-            if i != -1:
-                break
+        self.transport.settimeout(timeout)
 
-        if i != len(buf) - 1:
-            print("warning, garbage at end of command: %s" % repr(buf[i:]))
+        i = self.rbuf.find(self.EOM, self.rstart, self.rend)
+        while i == -1:
+            if self.rend == len(self.rbuf):
+                self.compact()
+            t0 = time.perf_counter()
+            n = self.transport.recv_into(self.rview[self.rend:])
+            if not n:
+                raise EOFError("connection closed by openocd")
 
-        s = buf[:i].decode('ascii')
+            # Time spent blocked waiting for openocd
+            self.stats.add('recv', n, time.perf_counter() - t0)
+
+            # Only look at the bytes that were just received
+            i = self.rbuf.find(self.EOM, self.rend, self.rend + n)
+            self.rend += n
+
+        s = str(self.rview[self.rstart:i], 'ascii')
+
+        if self.inflight:
+            t0, kind, buf = self.inflight.popleft()
+            t = time.perf_counter()
+            self.stats.add(kind, len(buf) + len(s) + 1, t - t0)
+            if self.recorder:
+                self.recorder.add(t0, t, buf[:-1].decode('ascii'), s)
+
+        self.rstart = i + 1
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
 
         if self.verbose:
             print("< %s" % s)
 
         return s
 
-class BsdlSemantics:
-    def map_string(self, ast):
-        parser = bsdl.bsdlParser()
-        ast = parser.parse(''.join(ast), "port_map")
-        return ast
+    def compact(self):
+        """Make room at the end of the receive buffer."""
+
+        n = self.rend - self.rstart
+        if self.rstart:
+            self.rview[:n] = self.rview[self.rstart:self.rend]
+        else:
+            self.rview.release()
+            self.rbuf.extend(bytes(len(self.rbuf)))
+            self.rview = memoryview(self.rbuf)
+        self.rstart = 0
+        self.rend = n
+
+def add_openocd_args(parser):
+    parser.add_argument('--host', default = '127.0.0.1',
+                        help = "host running the openocd Tcl server")
+    parser.add_argument('--port', type = int, default = 6666,
+                        help = "openocd Tcl server port")
+    parser.add_argument('--spawn', action = 'store_true',
+                        help = "start openocd and talk to it over a pipe")
+    parser.add_argument('--cfg', default = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'openocd.cfg'),
+                        help = "openocd configuration used with --spawn")
+    parser.add_argument('--openocd', default = 'openocd',
+                        help = "openocd binary used with --spawn")
+    parser.add_argument('--record',
+                        help = "record the openocd session to this file")
+    parser.add_argument('--replay',
+                        help = "replay a recorded session instead of using openocd")
+
+def open_openocd(args, verbose = 1):
+    if args.replay:
+        ocd = OpenOCD(verbose = verbose,
+                      transport = ReplayTransport(args.replay, verbose = verbose))
+    elif args.spawn:
+        ocd = OpenOCD.spawn(args.cfg, args.openocd, verbose = verbose)
+    else:
+        ocd = OpenOCD(args.host, args.port, verbose = verbose)
+    if args.record:
+        ocd.record(args.record)
+    return ocd
+
+class AsyncOpenOCD(object):
+    """asyncio counterpart to OpenOCD.
+
+    Any number of commands can be in flight at the same time.  Every
+    command gets a future which is put in a FIFO, a reader task
+    resolves the futures in order as the EOM terminated replies
+    arrive, which is the same order openocd executes the commands in.
+
+        ocd = await AsyncOpenOCD().connect()
+        ir, dr = await ocd.cmd_many([ 'irscan xc.tap 0xfe',
+                                      'drscan xc.tap 32 0' ])
+    """
+
+    EOM = OpenOCD.EOM
+
+    def __init__(self, host = '127.0.0.1', port = 6666, verbose = 1):
+        self.host = host
+        self.port = port
+        self.bufsize = 1 << 24
+        self.timeout = 30
+        self.verbose = verbose
+
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+        # Why the reader task stopped, commands fail with this after
+        self.error = None
+
+        # Futures for all commands which have been sent but whose
+        # reply has not arrived yet, oldest first
+        self.pending = collections.deque()
+
+        # Futures for commands sent with send, handed out by recv
+        self.unclaimed = collections.deque()
+
+    async def connect(self):
+        if self.verbose:
+            print("connecting to %s:%s" % (self.host, self.port))
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit = self.bufsize)
+        self.task = asyncio.ensure_future(self.read_replies())
+        return self
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self.task
+
+    async def read_replies(self):
+        error = EOFError("connection closed by openocd")
+        try:
+            while True:
+                buf = await self.reader.readuntil(self.EOM)
+                s = buf[:-1].decode('ascii')
+                if self.verbose:
+                    print("< %s" % s)
+                if not self.pending:
+                    # Replies can't be matched with commands any more
+                    error = IOError("protocol error, reply %s from openocd "
+                                    "without a command" % repr(s))
+                    break
+                fut = self.pending.popleft()
+                if not fut.done():
+                    fut.set_result(s)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.error = error
+        while self.pending:
+            fut = self.pending.popleft()
+            if not fut.done():
+                fut.set_exception(error)
+
+    def submit(self, s):
+        """Write a command and return a future for its reply."""
+
+        if self.verbose:
+            print("> %s" % s)
+        if not isinstance(s, bytes):
+            s = s.encode('ascii')
+        fut = asyncio.get_running_loop().create_future()
+        if self.error is not None:
+            fut.set_exception(self.error)
+            return fut
+        self.pending.append(fut)
+        self.writer.write(s + self.EOM)
+        return fut
+
+    async def wait(self, fut, timeout = None):
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(fut, timeout)
+
+    async def cmd(self, s, timeout = None):
+        fut = self.submit(s)
+        await self.writer.drain()
+        return await self.wait(fut, timeout = timeout)
+
+    async def cmd_many(self, cmds, timeout = None):
+        futs = [ self.submit(s) for s in cmds ]
+        await self.writer.drain()
+        return [ await self.wait(fut, timeout = timeout) for fut in futs ]
+
+    async def send(self, s, timeout = None):
+        self.unclaimed.append(self.submit(s))
+        await self.writer.drain()
+
+    async def recv(self, timeout = None):
+        return await self.wait(self.unclaimed.popleft(), timeout = timeout)
+
+def bsdl_parser_class():
+    """The grako BSDL parser, extended to parse the pin map and port
+    grouping strings in the same pass as the rest of the file.
+
+    These strings are small languages of their own and the generated
+    grammar only collects their quoted pieces.  Here the pieces are
+    parsed with the port_map and group_table rules directly from the
+    file with the quotes and the & joining the pieces treated as
+    whitespace.  (The cell table and opcode table are parsed by the
+    grammar directly.)
+    """
+
+    global _bsdl_parser_class
+    if _bsdl_parser_class is None:
+        import bsdl
+        from grako.parsing import graken
+
+        class BsdlParser(bsdl.bsdlParser):
+            STRING_WHITESPACE = re.compile(r'[\s"&]+')
+
+            def parse_text(self, text, rule, **kwargs):
+                self.text_buffer = bsdl.bsdlBuffer(text)
+                return self.parse(self.text_buffer, rule, **kwargs)
+
+            def in_string(self, rule):
+                buf = self.text_buffer
+                whitespace = buf.whitespace
+                buf.whitespace = self.STRING_WHITESPACE
+                try:
+                    rule()
+                    # Skip the closing quote
+                    buf.next_token()
+                finally:
+                    buf.whitespace = whitespace
+
+            @graken()
+            def _map_string_(self):
+                self.in_string(self._port_map_)
+
+            @graken()
+            def _group_table_string_(self):
+                self.in_string(self._group_table_)
+
+        _bsdl_parser_class = BsdlParser
+    return _bsdl_parser_class
+
+_bsdl_parser_class = None
+
+class BsdlExtractError(Exception):
+    pass
+
+class BsdlTokens(object):
+    """Token stream for the small languages inside BSDL strings."""
+
+    TOKEN_RE = re.compile(r'[A-Za-z0-9_]+|\S')
+
+    def __init__(self, s):
+        self.tokens = self.TOKEN_RE.findall(s)
+        self.i = 0
 
-    def grouped_port_identification(self, ast):
-        parser = bsdl.bsdlParser()
-        ast = parser.parse(''.join(ast), "group_table")
-        return ast
+    def done(self):
+        return self.i >= len(self.tokens)
+
+    def peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+        return None
+
+    def next(self, pattern = None):
+        t = self.peek()
+        if t is None:
+            raise BsdlExtractError("unexpected end of string")
+        if pattern is not None and not re.match(pattern + '$', t):
+            raise BsdlExtractError("unexpected %s" % repr(t))
+        self.i += 1
+        return t
+
+    def expect(self, token):
+        t = self.next()
+        if t != token:
+            raise BsdlExtractError("expected %s, got %s" % (repr(token), repr(t)))
+
+    def separator(self):
+        """Skip the comma(s) between two list entries."""
+
+        if self.done():
+            return
+        self.expect(',')
+        while self.peek() == ',':
+            self.next()
+
+IDENTIFIER = r'[A-Za-z][A-Za-z0-9_]*'
+INTEGER = r'[0-9]+'
+
+CELL_FUNCTIONS = [ 'INPUT', 'OUTPUT2', 'OUTPUT3', 'CONTROL', 'CONTROLR',
+                   'INTERNAL', 'CLOCK', 'BIDIR', 'OBSERVE_ONLY' ]
+
+def extract_opcode_table(s):
+    ops = []
+    tokens = BsdlTokens(s)
+    while not tokens.done():
+        name = tokens.next(IDENTIFIER)
+        tokens.expect('(')
+        codes = [ tokens.next('[01Xx]+') ]
+        while tokens.peek() == ',':
+            tokens.next()
+            codes.append(tokens.next('[01Xx]+'))
+        tokens.expect(')')
+        ops.append({ 'instruction_name' : name, 'opcode_list' : codes })
+        tokens.separator()
+    return ops
+
+def extract_cell_table(s):
+    cells = []
+    tokens = BsdlTokens(s)
+    while not tokens.done():
+        number = tokens.next(INTEGER)
+        tokens.expect('(')
+        cell_name = tokens.next(IDENTIFIER)
+        tokens.expect(',')
+        port = tokens.next()
+        if port != '*' and not re.match(IDENTIFIER + '$', port):
+            raise BsdlExtractError("bad port %s" % repr(port))
+        if tokens.peek() == '(':
+            raise BsdlExtractError("subscripted port %s" % repr(port))
+        tokens.expect(',')
+        function = tokens.next(IDENTIFIER).upper()
+        if function not in CELL_FUNCTIONS:
+            raise BsdlExtractError("unknown cell function %s" % repr(function))
+        tokens.expect(',')
+        safe_bit = tokens.next('[01Xx]').upper()
+
+        spec = None
+        if tokens.peek() == ',':
+            tokens.next()
+            t = tokens.next()
+            if tokens.peek() == ',':
+                tokens.next()
+                if not re.match(INTEGER + '$', t):
+                    raise BsdlExtractError("bad control cell %s" % repr(t))
+                disable_value = tokens.next('[01]')
+                tokens.expect(',')
+                spec = {
+                    'control_cell' : t,
+                    'disable_value' : disable_value,
+                    'disable_result' : tokens.next(IDENTIFIER).upper(),
+                }
+            else:
+                spec = t.upper()
+        tokens.expect(')')
+
+        cells.append({
+            'cell_number' : number,
+            'cell_info' : {
+                'cell_spec' : {
+                    'cell_name' : cell_name,
+                    'port_id' : port,
+                    'function' : function,
+                    'safe_bit' : safe_bit,
+                },
+                'input_or_disable_spec' : spec,
+            },
+        })
+        tokens.separator()
+    return cells
+
+def extract_port_map(s):
+    ports = []
+    tokens = BsdlTokens(s)
+    while not tokens.done():
+        port = tokens.next(IDENTIFIER)
+        tokens.expect(':')
+        if tokens.peek() == '(':
+            tokens.next()
+            pins = [ tokens.next() ]
+            while tokens.peek() == ',':
+                tokens.next()
+                pins.append(tokens.next())
+            tokens.expect(')')
+        else:
+            pins = [ tokens.next() ]
+        ports.append({ 'port_name' : port, 'pin_list' : pins })
+        tokens.separator()
+    return ports
+
+BSDL_COMMENT_RE = re.compile(r'--[^\n]*')
+BSDL_ENTITY_RE = re.compile(r'\bentity\s+(%s)\s+is\b' % IDENTIFIER, re.I)
+BSDL_STMT_RE = re.compile(
+    r'\b(attribute|constant)\s+(%s)\s*(?:of\s+(%s)\s*)?:\s*(%s)\s*(?:is|:=)'
+    r'((?:"[^"]*"|[^;"])*);' % (IDENTIFIER, IDENTIFIER, IDENTIFIER), re.I)
+BSDL_STRING_RE = re.compile(r'"([^"]*)"')
+
+def extract_bsdl(text):
+    """Fast extraction of the parts of a BSDL file ParsedBsdl uses.
+
+    Only the statements that are needed are looked at: the entity
+    name, INSTRUCTION_LENGTH, INSTRUCTION_OPCODE, IDCODE_REGISTER,
+    BOUNDARY_LENGTH, BOUNDARY_REGISTER and the PIN_MAP_STRING
+    constants.  The result has the same layout as the corresponding
+    parts of the full parser's asjson() output.  Anything unexpected
+    raises BsdlExtractError so that the caller can fall back to the
+    full parser.
+    """
+
+    text = BSDL_COMMENT_RE.sub('', text)
+
+    m = BSDL_ENTITY_RE.search(text)
+    if not m:
+        raise BsdlExtractError("no entity")
+    name = m.group(1)
+
+    attributes = {}
+    pin_mappings = []
+    for m in BSDL_STMT_RE.finditer(text):
+        kind, stmt, entity, stmt_type, value = m.groups()
+        value = value.strip()
+        if kind.lower() == 'constant':
+            if stmt_type.upper() == 'PIN_MAP_STRING':
+                pin_mappings.append({
+                    'pin_mapping_name' : stmt,
+                    'pin_map' : extract_port_map(''.join(BSDL_STRING_RE.findall(value))),
+                })
+        elif entity is not None and entity.upper() == name.upper():
+            attributes[stmt.upper()] = value
+
+    def integer(stmt):
+        if not re.match(INTEGER + '$', attributes.get(stmt, '')):
+            raise BsdlExtractError("bad or missing %s" % stmt)
+        return attributes[stmt]
+
+    def strings(stmt):
+        value = attributes.get(stmt)
+        if value is None:
+            raise BsdlExtractError("missing %s" % stmt)
+        if BSDL_STRING_RE.sub('', value).replace('&', '').strip():
+            raise BsdlExtractError("%s is not a string" % stmt)
+        return BSDL_STRING_RE.findall(value)
+
+    registers = []
+    if 'IDCODE_REGISTER' in attributes:
+        registers.append({ 'idcode_register' : strings('IDCODE_REGISTER') })
+
+    return {
+        'component_name' : name,
+        'instruction_register_description' : {
+            'instruction_length' : integer('INSTRUCTION_LENGTH'),
+            'instruction_opcodes' : extract_opcode_table(''.join(strings('INSTRUCTION_OPCODE'))),
+        },
+        'optional_register_description' : registers,
+        'boundary_scan_register_description' : {
+            'fixed_boundary_stmts' : {
+                'boundary_length' : integer('BOUNDARY_LENGTH'),
+                'boundary_register' : extract_cell_table(''.join(strings('BOUNDARY_REGISTER'))),
+            },
+        },
+        'device_package_pin_mappings' : pin_mappings,
+    }
+
+def bsdl_parser_version(fast = False):
+    """Hash of the parser source, part of the key for cached tables.
+
+    The fast extractor and the extensions to the full parser are in
+    this file, so the source of this file is part of the hash too, and
+    so is the mode.
+    """
+
+    if fast not in _bsdl_parser_versions:
+        d = os.path.dirname(os.path.abspath(__file__))
+        fns = [ os.path.join(d, 'bsdl.py'), os.path.abspath(__file__) ]
+        h = hashlib.sha256()
+        for fn in fns:
+            with open(fn, 'rb') as f:
+                h.update(f.read())
+        h.update(b'%u %s' % (ParsedBsdl.CACHE_VERSION,
+                             fast and b'fast' or b'full'))
+        _bsdl_parser_versions[fast] = h.hexdigest()[:16]
+    return _bsdl_parser_versions[fast]
+
+_bsdl_parser_versions = {}
 
 class ParsedBsdl(object):
-    def __init__(self, fn):
-        with open(fn) as f:
-            text = f.read()
+    # Bump when the way the tables are extracted changes
+    CACHE_VERSION = 2
+
+    # Everything the tools use from a BSDL file.  These are stored in
+    # a cache keyed by the hash of the file and the parser version and
+    # mode so that the (slow) parser only has to run once per file.
+    TABLES = [ 'name', 'oplen', 'opcodes', 'chainlen', 'idcode_idmask',
+               'cells', 'portmaps', 'pinmaps' ]
+
+    def __init__(self, fn, cache = True, fast = True):
+        self.fn = fn
+        self.fast = fast
+        with open(fn, 'rb') as f:
+            data = f.read()
+        self.text = data.decode('latin-1')
+
+        self.cachefn = None
+        if cache:
+            self.cachefn = os.path.join(CACHE_DIR, 'bsdl', '%s-%s.json' % (
+                hashlib.sha256(data).hexdigest()[:32],
+                bsdl_parser_version(bool(fast))))
+            tables = load_json(self.cachefn)
+            if tables is not None:
+                self.load_tables(tables)
+                return
+
+            # Carry on without the cache if it can't be written
+            try:
+                save_json(self.cachefn, dict(
+                    self.get_tables(),
+                    register_descriptions = self.register_descriptions))
+            except OSError as e:
+                print("warning: can't write BSDL cache: %s" % e)
+
+    @classmethod
+    def from_idcode(cls, idcode, package = None, index = None):
+        """Open the BSDL file for a device given the IDCODE read from it."""
+
+        if index is None:
+            index = BsdlIndex()
+        return cls(index.find(idcode, package)['fn'])
+
+    def get_tables(self):
+        return dict([ (name, getattr(self, name)) for name in self.TABLES ])
+
+    def load_tables(self, tables):
+        # Put the values in the instance dict where the lazy_value
+        # descriptors would have put them
+        for name in self.TABLES + [ 'register_descriptions' ]:
+            self.__dict__[name] = tables[name]
+        self.__dict__['idcode_idmask'] = tuple(tables['idcode_idmask'])
+
+    def check_parsed(self):
+        if self.__dict__.get('compiled'):
+            raise ValueError("%s: compiled, the parse data has been dropped" %
+                             self.fn)
 
-        parser = bsdl.bsdlParser()
-        ast = parser.parse(text, 'bsdl_description',
-                           semantics = BsdlSemantics(),
-                           parseinfo = False)
+    @lazy_value
+    def ast(self):
+        self.check_parsed()
+        parser = bsdl_parser_class()()
+        return parser.parse_text(self.text, 'bsdl_description',
+                                 parseinfo = False)
 
-        self.ast = ast
-        self.json = ast.asjson()
+    @lazy_value
+    def json(self):
+        self.check_parsed()
+        return self.ast.asjson()
+
+    @lazy_value
+    def desc(self):
+        """The parts of the parsed file the tables are built from."""
+
+        self.check_parsed()
+
+        if self.fast:
+            try:
+                desc = extract_bsdl(self.text)
+                self.extractor = 'fast'
+                return desc
+            except BsdlExtractError as e:
+                print("warning: %s: %s, using the full BSDL parser" % (self.fn, e))
+        self.extractor = 'full'
+        return self.json
 
     @lazy_value
     def name(self):
-        return self.json['component_name']
+        return self.desc['component_name']
+
+    @lazy_value
+    def register_descriptions(self):
+        descriptions = {}
+        for d in self.desc['optional_register_description']:
+            descriptions.update(d)
+        return descriptions
 
     def get_register_description(self, name):
-        for d in self.json['optional_register_description']:
-            pprint(d)
-            for k, v in d.items():
-                if k == name:
-                    return v
-        return None
+        return self.register_descriptions.get(name)
 
     @lazy_value
     def idcode_idmask(self):
@@ -153,12 +1073,12 @@ class ParsedBsdl(object):
 
     @lazy_value
     def oplen(self):
-        return int(self.json['instruction_register_description']['instruction_length'], 10)
+        return int(self.desc['instruction_register_description']['instruction_length'], 10)
 
     @lazy_value
     def opcodes(self):
         opcodes = {}
-        for op in self.json['instruction_register_description']['instruction_opcodes']:
+        for op in self.desc['instruction_register_description']['instruction_opcodes']:
             name = op['instruction_name']
             value = op['opcode_list']
             assert len(value) == 1
@@ -168,12 +1088,12 @@ class ParsedBsdl(object):
 
     @lazy_value
     def chainlen(self):
-        return int(self.json['boundary_scan_register_description']['fixed_boundary_stmts']['boundary_length'], 10)
+        return int(self.desc['boundary_scan_register_description']['fixed_boundary_stmts']['boundary_length'], 10)
 
     @lazy_value
     def cells(self):
         cells = {}
-        for d in self.json['boundary_scan_register_description']['fixed_boundary_stmts']['boundary_register']:
+        for d in self.desc['boundary_scan_register_description']['fixed_boundary_stmts']['boundary_register']:
             name = d['cell_info']['cell_spec']['port_id']
             if name == '*':
                 continue
@@ -224,7 +1144,7 @@ class ParsedBsdl(object):
     @lazy_value
     def portmaps(self):
         portmaps = {}
-        for m in self.json['device_package_pin_mappings']:
+        for m in self.desc['device_package_pin_mappings']:
             name = m['pin_mapping_name']
             portmap = {}
             for d in m['pin_map']:
@@ -246,19 +1166,632 @@ class ParsedBsdl(object):
             pinmaps[name] = pinmap
         return pinmaps
 
+    def compile(self):
+        """Build a CompiledDevice and drop the parse results.
+
+        The tables the CompiledDevice is built from and the register
+        descriptions are kept, the text, the AST and the JSON dump are
+        not needed any more and using them afterwards raises ValueError.
+        """
+
+        device = CompiledDevice(self)
+        self.register_descriptions
+        for name in [ 'text', 'ast', 'json', 'desc' ]:
+            self.__dict__.pop(name, None)
+        self.compiled = True
+        return device
+
+def safe_bit(s):
+    if s.upper() == 'X':
+        return -1
+    return int(s, 2)
+
+class CompiledDevice(object):
+    """Compact description of a device built from a ParsedBsdl.
+
+    Ports are numbered in name order and everything per port is a
+    tuple indexed by the port number.  Cell numbers are -1 for cells
+    a port does not have, masks are 1 << cell number or 0.  A bidir
+    cell is both the input and the output cell of its port.
+
+    The lookups go through dicts and tuples built once here:
+
+        port_index[name]        port number of a port name
+        pinmap[pin]             port number of a package pin
+        port_pins[port]         package pins of a port
+        cell_port[cell]         port number of a cell, -1 for control
+                                and internal cells
+        cell_role[cell]         'input', 'output', 'bidir', 'control'
+                                or 'internal'
+        function_cells[role]    cell numbers with that role
+        control_ports[cell]     port numbers a control cell disables
+    """
+
+    __slots__ = [ 'name', 'oplen', 'opcodes', 'chainlen', 'idcode', 'idmask',
+                  'ports', 'port_index', 'pinmap',
+                  'input', 'output', 'control',
+                  'input_safe', 'output_safe', 'disable_value',
+                  'input_mask', 'output_mask', 'control_mask',
+                  'enable_bits', 'disable_bits',
+                  'safe_bits', 'safe_mask',
+                  'port_pins', 'cell_port', 'cell_role', 'function_cells',
+                  'control_ports' ]
+
+    def __init__(self, bsdl):
+        self.name = bsdl.name
+        self.oplen = bsdl.oplen
+        self.opcodes = dict(bsdl.opcodes)
+        self.chainlen = bsdl.chainlen
+        self.idcode, self.idmask = bsdl.idcode_idmask
+
+        self.ports = tuple(sorted(bsdl.cells.keys()))
+        self.port_index = dict([ (name, i) for i, name in enumerate(self.ports) ])
+
+        # Pin name to port number and back for the first package
+        self.pinmap = {}
+        port_pins = [ () ] * len(self.ports)
+        if bsdl.pinmaps:
+            package = sorted(bsdl.pinmaps.keys())[0]
+            for pin, port in bsdl.pinmaps[package].items():
+                if port in self.port_index:
+                    self.pinmap[pin] = self.port_index[port]
+            for port, pins in bsdl.portmaps[package].items():
+                if port in self.port_index:
+                    port_pins[self.port_index[port]] = tuple(pins)
+        self.port_pins = tuple(port_pins)
+
+        inputs = []
+        outputs = []
+        controls = []
+        input_safe = []
+        output_safe = []
+        disable_value = []
+        for name in self.ports:
+            cell = bsdl.cells[name]
+            if 'io' in cell:
+                inputs.append(cell['io'])
+                outputs.append(cell['io'])
+                controls.append(cell['dir'])
+                input_safe.append(-1)
+                output_safe.append(safe_bit(cell['output_safe_bit']))
+                disable_value.append(cell['dir_disable_value'])
+                continue
+
+            inputs.append(cell.get('input', -1))
+            input_safe.append(safe_bit(cell.get('input_safe_bit', 'X')))
+            outputs.append(cell.get('output', -1))
+            output_safe.append(safe_bit(cell.get('output_safe_bit', 'X')))
+            controls.append(cell.get('oe', -1))
+            disable_value.append(cell.get('oe_disable_value', 0))
+
+        def masks(cells):
+            return tuple([ 1 << c if c >= 0 else 0 for c in cells ])
+
+        self.input = tuple(inputs)
+        self.output = tuple(outputs)
+        self.control = tuple(controls)
+        self.input_safe = tuple(input_safe)
+        self.output_safe = tuple(output_safe)
+        self.disable_value = tuple(disable_value)
+
+        self.input_mask = masks(inputs)
+        self.output_mask = masks(outputs)
+        self.control_mask = masks(controls)
+
+        # Value of the control cell which enables or disables the
+        # output driver, already shifted into place
+        self.enable_bits = tuple([ m if not v else 0 for m, v in
+                                   zip(self.control_mask, disable_value) ])
+        self.disable_bits = tuple([ m if v else 0 for m, v in
+                                    zip(self.control_mask, disable_value) ])
+
+        # Reverse maps from cell numbers
+        cell_port = [ -1 ] * self.chainlen
+        cell_role = [ 'internal' ] * self.chainlen
+        control_ports = {}
+        for i in range(len(self.ports)):
+            if controls[i] >= 0:
+                cell_role[controls[i]] = 'control'
+                control_ports.setdefault(controls[i], []).append(i)
+            if inputs[i] >= 0:
+                cell_port[inputs[i]] = i
+                cell_role[inputs[i]] = 'input'
+            if outputs[i] >= 0:
+                cell_port[outputs[i]] = i
+                if outputs[i] == inputs[i]:
+                    cell_role[outputs[i]] = 'bidir'
+                else:
+                    cell_role[outputs[i]] = 'output'
+        self.cell_port = tuple(cell_port)
+        self.cell_role = tuple(cell_role)
+        self.control_ports = dict([ (c, tuple(ports))
+                                    for c, ports in control_ports.items() ])
+        function_cells = {}
+        for c, role in enumerate(cell_role):
+            function_cells.setdefault(role, []).append(c)
+        self.function_cells = dict([ (role, tuple(cells))
+                                     for role, cells in function_cells.items() ])
+
+        # Chain with every output disabled and the output cells at
+        # their safe values
+        self.safe_bits = 0
+        self.safe_mask = 0
+        for i in range(len(self.ports)):
+            self.safe_mask |= self.control_mask[i]
+            self.safe_bits |= self.disable_bits[i]
+            if output_safe[i] >= 0 and outputs[i] != controls[i]:
+                self.safe_mask |= self.output_mask[i]
+                if output_safe[i]:
+                    self.safe_bits |= self.output_mask[i]
+
+    def port(self, name):
+        """Port number of a port name or a package pin."""
+
+        if name in self.port_index:
+            return self.port_index[name]
+        return self.pinmap[name]
+
+    def shared_control(self, port):
+        """Ports which are disabled together with a port because they
+        share its control cell."""
+
+        return self.control_ports.get(self.control[port], ())
+
+class BoundaryBus(object):
+    """A group of ports driven and read as one binary value.
+
+    Bit i of the value is port ports[i].  For every byte of the value
+    there is a table of the boundary register bits to OR in for each
+    of the 256 values, and a dict from the captured input bits of
+    that byte to its value, so a whole bus is set or read with a few
+    big int operations per byte instead of several per bit.
+    """
+
+    __slots__ = [ 'ports', 'width', 'keep_mask', 'enable_bits',
+                  'release_mask', 'disable_bits', 'set_luts', 'get_luts' ]
+
+    def __init__(self, device, ports):
+        self.ports = tuple(ports)
+        self.width = len(ports)
+
+        output_mask = 0
+        control_mask = 0
+        self.enable_bits = 0
+        self.disable_bits = 0
+        for i in ports:
+            output_mask |= device.output_mask[i]
+            control_mask |= device.control_mask[i]
+            self.enable_bits |= device.enable_bits[i]
+            self.disable_bits |= device.disable_bits[i]
+        self.keep_mask = ~(output_mask | control_mask)
+        self.release_mask = ~control_mask
+
+        self.set_luts = []
+        self.get_luts = []
+        for shift in range(0, self.width, 8):
+            byte = ports[shift : shift + 8]
+            set_lut = []
+            for v in range(256):
+                t = 0
+                for j, i in enumerate(byte):
+                    if (v >> j) & 1:
+                        t |= device.output_mask[i]
+                set_lut.append(t)
+            get_lut = {}
+            mask = 0
+            for v in range(1 << len(byte)):
+                t = 0
+                for j, i in enumerate(byte):
+                    if (v >> j) & 1:
+                        t |= device.input_mask[i]
+                get_lut.setdefault(t, v)
+                mask |= t
+            self.set_luts.append((shift, tuple(set_lut)))
+            self.get_luts.append((shift, mask, get_lut))
+
+    def set(self, t, value):
+        """Drive value on the bus, returns the new register value."""
+
+        t = (t & self.keep_mask) | self.enable_bits
+        for shift, lut in self.set_luts:
+            t |= lut[(value >> shift) & 0xff]
+        return t
+
+    def release(self, t):
+        """Tristate the bus."""
+
+        return (t & self.release_mask) | self.disable_bits
+
+    def get(self, t):
+        """Value on the bus in a captured register value."""
+
+        value = 0
+        for shift, mask, lut in self.get_luts:
+            value |= lut[t & mask] << shift
+        return value
+
+class BoundaryState(object):
+    """A boundary register vector with named buses on it.
+
+    buses maps a name to a list of port numbers in the device, bit 0
+    first.
+    """
+
+    def __init__(self, device, buses, value = 0):
+        self.device = device
+        self.value = value
+        self.buses = {}
+        for name, ports in buses.items():
+            self.buses[name] = BoundaryBus(device, ports)
+
+    def set(self, name, value):
+        self.value = self.buses[name].set(self.value, value)
+
+    def release(self, name):
+        self.value = self.buses[name].release(self.value)
+
+    def get(self, name, t):
+        return self.buses[name].get(t)
+
+class BatchEncoder(object):
+    """Build and decode many boundary register vectors at once.
+
+    Uses NumPy, which is only needed if this class is used.  Vectors
+    are handled as arrays of little endian bytes with one row per
+    vector, the buses are those of a BoundaryState.
+    """
+
+    def __init__(self, state):
+        import numpy
+        self.np = numpy
+
+        device = state.device
+        self.nbits = device.chainlen
+        self.nbytes = (device.chainlen + 7) // 8
+
+        # Per bus: keep, release, enable and disable masks as byte
+        # rows, the byte tables of the BoundaryBus as arrays with one
+        # row per value and the input cell of each bit.
+        self.buses = {}
+        for name, bus in state.buses.items():
+            luts = [ (shift, self.to_array(lut))
+                     for shift, lut in bus.set_luts ]
+            inputs = [ device.input[i] for i in bus.ports ]
+            self.buses[name] = (
+                self.to_array([ bus.keep_mask ])[0],
+                self.to_array([ bus.release_mask ])[0],
+                self.to_array([ bus.enable_bits ])[0],
+                self.to_array([ bus.disable_bits ])[0],
+                numpy.arange(bus.width),
+                luts,
+                numpy.array(inputs))
+
+    def to_array(self, vectors):
+        mask = (1 << self.nbits) - 1
+        data = b''.join([ (t & mask).to_bytes(self.nbytes, 'little')
+                          for t in vectors ])
+        return self.np.frombuffer(data, self.np.uint8).reshape(-1, self.nbytes)
+
+    def to_ints(self, a):
+        data = a.tobytes()
+        n = self.nbytes
+        return [ int.from_bytes(data[i : i + n], 'little')
+                 for i in range(0, len(data), n) ]
+
+    def encode(self, base, buses):
+        """Vectors with the bus values in buses applied to base.
+
+        buses maps a bus name to an array with one value per vector,
+        a negative value tristates the bus.  Returns a list of ints.
+        """
+
+        np = self.np
+        n = max([ len(values) for values in buses.values() ])
+        a = np.repeat(self.to_array([ base ]), n, axis = 0)
+        for name, values in buses.items():
+            keep, release, enable, disable, shifts, luts, inputs = self.buses[name]
+            values = np.asarray(values, np.int64)
+            driven = values >= 0
+            a &= np.where(driven[:, None], keep, release)
+            a |= np.where(driven[:, None], enable, disable)
+            values = np.where(driven, values, 0)
+            for shift, lut in luts:
+                a |= lut[(values >> shift) & 0xff]
+        return self.to_ints(a)
+
+    def bits(self, captures):
+        """Array with one row of register bits per captured value."""
+
+        return self.np.unpackbits(self.to_array(captures), axis = 1,
+                                  bitorder = 'little')
+
+    def decode(self, captures, name):
+        """Array with the value of a bus in each captured value."""
+
+        np = self.np
+        keep, release, enable, disable, shifts, luts, inputs = self.buses[name]
+        bits = self.bits(captures)[:, np.maximum(inputs, 0)].astype(np.int64)
+        bits[:, inputs < 0] = 0
+        return (bits << shifts).sum(axis = 1)
+
+    def decode_pins(self, captures, cells):
+        """Array with the captured bits of the given cells."""
+
+        return self.bits(captures)[:, list(cells)]
+
+# Where to look for BSDL files when a device is looked up by IDCODE,
+# a list of directories separated by os.pathsep
+BSDL_PATH = os.environ.get('EMU2000_BSDL_PATH', '/opt/Xilinx/14.7/ISE_DS/ISE')
+
+def find_bsdl_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.lower().endswith(('.bsd', '.bsdl')):
+                    yield os.path.join(root, fn)
+
+def file_sha256(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), b''):
+            h.update(data)
+    return h.hexdigest()
+
+def index_bsdl_file(fn):
+    """Index entry for one BSDL file, runs in a worker process."""
+
+    st = os.stat(fn)
+    entry = {
+        'mtime' : st.st_mtime,
+        'size' : st.st_size,
+        'sha256' : file_sha256(fn),
+        }
+    try:
+        bsdl = ParsedBsdl(fn)
+        idcode, idmask = bsdl.idcode_idmask
+        entry.update({
+            'name' : bsdl.name,
+            'packages' : sorted(bsdl.pinmaps.keys()),
+            'irlen' : bsdl.oplen,
+            'idcode' : idcode & idmask,
+            'idmask' : idmask,
+            })
+    except Exception as e:
+        entry['error'] = str(e)
+        entry['parser'] = bsdl_parser_version(True)
+    return entry
+
+class BsdlIndex(object):
+    """Index of a BSDL library keyed by masked IDCODE.
+
+    The index is kept in ~/.cache/emu2000/bsdl_index.json.  update()
+    only parses files which are new or have changed, the mtime and
+    size are checked first and the hash of the contents if they differ.
+    Files which could not be parsed are kept with an error and the
+    parser version, they are parsed again when the file or the parser
+    has changed (or with --rebuild).
+    """
+
+    VERSION = 1
+
+    def __init__(self, fn = None):
+        if fn is None:
+            fn = os.path.join(CACHE_DIR, 'bsdl_index.json')
+        self.fn = fn
+        index = load_json(fn)
+        if index is None or index.get('version') != self.VERSION:
+            index = { 'version' : self.VERSION, 'files' : {} }
+        self.files = index['files']
+
+    def save(self):
+        idcodes = {}
+        for fn, entry in sorted(self.files.items()):
+            if 'idcode' in entry:
+                idcodes.setdefault('%08x' % entry['idcode'], []).append(fn)
+        try:
+            save_json(self.fn, { 'version' : self.VERSION,
+                                 'files' : self.files,
+                                 'idcodes' : idcodes })
+        except OSError as e:
+            print("warning: can't write BSDL index: %s" % e)
+
+    def update(self, paths = None, jobs = None, verbose = 1):
+        """Index the BSDL files found in paths, returns the number of
+        files that were parsed."""
+
+        if paths is None:
+            paths = BSDL_PATH.split(os.pathsep)
+        paths = [ os.path.abspath(path) for path in paths ]
+
+        parser = bsdl_parser_version(True)
+        found = set()
+        todo = []
+        for fn in find_bsdl_files(paths):
+            found.add(fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            # Files which failed are tried again when the parser has
+            # changed, otherwise only if they have changed
+            entry = self.files.get(fn)
+            if entry is not None and entry.get(
+                    'parser', parser) == parser:
+                if entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+                    continue
+                if entry['size'] == st.st_size and entry['sha256'] == file_sha256(fn):
+                    entry['mtime'] = st.st_mtime
+                    continue
+            todo.append(fn)
+
+        # Forget files which have disappeared from the indexed trees
+        for fn in list(self.files.keys()):
+            if fn not in found and any(
+                    fn == path or fn.startswith(path + os.sep) for path in paths):
+                del self.files[fn]
+
+        if todo:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                for fn, entry in zip(todo, executor.map(index_bsdl_file, todo)):
+                    if verbose:
+                        if 'error' in entry:
+                            print("%s: %s" % (fn, entry['error']))
+                        elif verbose > 1:
+                            print("%08x %s" % (entry['idcode'], fn))
+                    self.files[fn] = entry
+
+        self.save()
+        return len(todo)
+
+    def lookup(self, idcode):
+        """All entries matching an IDCODE read from a device."""
+
+        matches = []
+        for fn, entry in sorted(self.files.items()):
+            if 'idcode' in entry and idcode & entry['idmask'] == entry['idcode']:
+                match = dict(entry)
+                match['fn'] = fn
+                matches.append(match)
+        return matches
+
+    def find(self, idcode, package = None, update = True):
+        """The one entry matching an IDCODE and package.
+
+        If nothing matches the index is updated from BSDL_PATH and the
+        lookup is retried.
+        """
+
+        matches = self.lookup(idcode)
+        if package is not None:
+            matches = [ m for m in matches if package.upper() in
+                        [ p.upper() for p in m['packages'] ] ]
+
+        if not matches and update:
+            self.update(verbose = 0)
+            return self.find(idcode, package, update = False)
+
+        if not matches:
+            raise ValueError("no BSDL file for idcode 0x%08x%s" % (
+                idcode, package and " package %s" % package or ''))
+        if len(matches) > 1:
+            raise ValueError("several BSDL files for idcode 0x%08x, "
+                             "give a package: %s" % (idcode, ', '.join(
+                                 [ m['fn'] for m in matches ])))
+        return matches[0]
+
+def read_reset_idcode(ocd, tap):
+    """Read the IDCODE of a TAP without knowing its instructions.
+
+    Test-Logic-Reset selects the IDCODE register in every device that
+    has one.
+    """
+
+    return int(ocd.cmd_many([ 'pathmove RESET',
+                              'drscan %s 32 0' % tap ])[1], 16)
+
+def discover_chain(ocd, tap, maxlen = 1024):
+    """Count the devices on a JTAG chain and read their IDCODEs.
+
+    After Test-Logic-Reset every device has its IDCODE register
+    selected, or BYPASS if it has none.  An IDCODE always starts with
+    a 1 and BYPASS captures a 0, so the chain can be walked from the
+    TDO end.  Ones are shifted in, an IDCODE of all ones marks the end
+    of the chain.  Returns a list of IDCODEs starting with the device
+    closest to TDO (the same order openocd numbers its taps in), None
+    for a device without an IDCODE.
+    """
+
+    n = maxlen + 32
+    t = int(ocd.cmd_many([ 'pathmove RESET',
+                           'drscan %s %u 0x%x' % (tap, n, (1 << n) - 1) ])[1], 16)
+
+    idcodes = []
+    pos = 0
+    while pos < maxlen:
+        if not (t >> pos) & 1:
+            idcodes.append(None)
+            pos += 1
+            continue
+        idcode = (t >> pos) & 0xffffffff
+        if idcode == 0xffffffff:
+            return idcodes
+        idcodes.append(idcode)
+        pos += 32
+
+    raise ValueError("no end of the JTAG chain found in %u bits" % maxlen)
+
+def load_scan_proc(ocd):
+    ocd.cmd(BS.SCAN_PROC)
+    if ocd.cmd('info procs emu2000_scan').strip() != 'emu2000_scan':
+        print("warning: could not load emu2000_scan, using irscan/drscan")
+        return False
+    return True
+
+def add_bsdl_args(parser, package = 'VQ64'):
+    parser.add_argument('--bsdl',
+                        help = "BSDL file for the CPLD, default is to look up "
+                        "the IDCODE in the BSDL index")
+    parser.add_argument('--package', default = package,
+                        help = "package used when looking up the BSDL file")
+
 class BS(object):
-    def __init__(self, ocd, tap, fn, verbose = 1):
+    # Tcl procedure which is uploaded to openocd so that a whole list
+    # of boundary scan vectors can be shifted with a single command.
+    # The instruction is loaded once and then each vector is scanned,
+    # the reply is the list of captured values.  An op of "-" keeps
+    # the instruction which is already loaded.
+    SCAN_PROC = '''proc emu2000_scan {tap op len vectors} {
+    if {$op ne "-"} {
+        irscan $tap $op
+    }
+    set r {}
+    foreach v $vectors {
+        lappend r [drscan $tap $len $v]
+    }
+    return $r
+}'''
+
+    def __init__(self, ocd, tap, fn = None, verbose = 1, tcl = True,
+                 package = None):
         self.ocd = ocd
         self.tap = tap
         self.verbose = verbose
         self.flushcount = 1024
 
-        self.bsdl = ParsedBsdl(fn)
+        # Maximum number of vectors passed to one emu2000_scan call
+        self.scanbatch = 256
+
+        # Length of the data register with all devices in BYPASS
+        self.bypass_len = 1
+
+        # Instruction last loaded by this object and ocd.serial right
+        # after it, None if unknown.  If anything else has been sent
+        # on the connection since then the instruction is loaded again.
+        self.ir = None
+        self.ir_serial = None
+
+        # Time spent in each kind of scan including building the
+        # commands and parsing the replies, compare with ocd.stats to
+        # see how much of it is spent on the Python side.
+        self.stats = Stats()
+
+        if fn is None:
+            self.bsdl = ParsedBsdl.from_idcode(read_reset_idcode(ocd, tap), package)
+        else:
+            self.bsdl = ParsedBsdl(fn)
+        if self.verbose:
+            print("bsdl", self.bsdl.fn)
 
         if 0:
             print(json.dumps(self.bsdl.json, indent = 4))
             print()
 
+        self.device = self.bsdl.compile()
+
         if self.verbose:
             print("name", self.bsdl.name)
 
@@ -295,29 +1828,216 @@ class BS(object):
         self.chainlen = self.bsdl.chainlen
         if self.verbose:
             print('chainlen', self.chainlen)
+        self.chainbytes = (self.chainlen + 7) // 8
 
         self.idcode, self.idmask = self.bsdl.idcode_idmask
         if self.verbose:
             print("idcode {0:08x} {0:032b}".format(self.idcode))
             print("idmask {0:08x} {0:032b}".format(self.idmask))
 
+        self.tcl = tcl and self.load_tcl()
+        if self.verbose:
+            print("tcl scan", self.tcl)
+
+        # Adapter speed in kHz once set_speed has been called
+        self.speed = None
+
+    def load_tcl(self):
+        return load_scan_proc(self.ocd)
+
+    # The scan commands are built with these so that a subclass can
+    # put the device on a chain with other devices
+
+    def ir_value(self, op):
+        return op
+
+    def dr_value(self, n, data):
+        """Length and value of the scan which puts data in an n bit register."""
+        return n, data
+
+    def dr_capture(self, n, t):
+        return t
+
+    def ir_cmd(self, op):
+        return 'irscan %s 0x%x' % (self.tap, self.ir_value(op))
+
+    def dr_cmd(self, n, data):
+        return 'drscan %s %u 0x%x' % ((self.tap,) + self.dr_value(n, data))
+
+    def ir_cmds(self, op):
+        """The irscan needed to load op, empty if it is already loaded."""
+
+        if self.ir == op and self.ir_serial == self.ocd.serial:
+            self.stats.add('irscan skipped', 0, 0)
+            return []
+        return [ self.ir_cmd(op) ]
+
+    def ir_loaded(self, op):
+        self.ir = op
+        self.ir_serial = self.ocd.serial
+
+    def invalidate_ir(self):
+        self.ir = None
+
+    def dr_scan(self, op, n, data):
+        t = self.ocd.cmd_many(self.ir_cmds(op) + [ self.dr_cmd(n, data) ])[-1]
+        self.ir_loaded(op)
+        return self.dr_capture(n, int(t, 16))
+
+    def reset(self):
+        """Reset the TAP, this selects the IDCODE instruction."""
+
+        self.ocd.cmd('pathmove RESET')
+
+        # Other devices on a chain are in IDCODE too, not in BYPASS,
+        # so the next scan has to load the instruction register
+        self.invalidate_ir()
+
+    def read_idcode(self):
+        return self.dr_scan(self.op_idcode, 32, 0)
+
     def check_idcode(self):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_idcode))
-        t = int(self.ocd.cmd('drscan %s 32 0' % self.tap), 16)
+        t = self.read_idcode()
 
         assert t & self.idmask == self.idcode & self.idmask
 
     def check_usercode(self):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_usercode))
-        t = int(self.ocd.cmd('drscan %s 32 0' % self.tap), 16)
+        t = self.dr_scan(self.op_usercode, 32, 0)
 
         print("usercode 0x%08x" % t)
 
     def bypass(self):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_bypass))
+        self.ocd.cmd(self.ir_cmd(self.op_bypass))
+        self.ir_loaded(self.op_bypass)
+
+    def set_speed(self, khz):
+        self.ocd.cmd('adapter speed %u' % khz)
+        self.ocd.note(speed = khz)
+        self.speed = khz
+
+    def check_link(self, port = None, rounds = 8, seed = 0):
+        """Check that scans work reliably at the current adapter speed.
+
+        Reads IDCODE, shifts a random pattern through the BYPASS
+        register and, if a port is given, drives random values on that
+        port with EXTEST and checks that its input cell reads them back.
+        The patterns come from seed so a recorded check can be replayed.
+        """
+
+        rng = random.Random(seed)
+
+        for i in range(rounds):
+            if self.read_idcode() & self.idmask != self.idcode & self.idmask:
+                return False
+
+        # With everything in BYPASS the chain is one bit per device
+        for i in range(rounds):
+            pattern = rng.getrandbits(64)
+            n = 64 + self.bypass_len
+            t = int(self.ocd.cmd_many([
+                self.ir_cmd(self.op_bypass),
+                'drscan %s %u 0x%x' % (self.tap, n, pattern) ])[1], 16)
+            if t >> self.bypass_len != pattern:
+                return False
+
+        if port is not None:
+            dev = self.device
+            i = dev.port_index[port]
+            base = (self.sample() & ~dev.control_mask[i]) | dev.disable_bits[i]
+            enable = (base & ~(dev.control_mask[i] | dev.output_mask[i])) | dev.enable_bits[i]
+            bits = [ rng.getrandbits(1) for i in range(rounds) ]
+            vectors = []
+            for bit in bits:
+                v = enable | (dev.output_mask[i] if bit else 0)
+                # The first scan drives the pin, the second captures it
+                vectors += [ v, v ]
+            captures = self.extest_many(vectors)
+            self.sample(base)
+            for j, bit in enumerate(bits):
+                if (captures[2 * j + 1] >> dev.input[i]) & 1 != bit:
+                    return False
+
+        return True
+
+    def calibrate(self, port = None, start = 500, limit = 32000, steps = 3,
+                  rounds = 8, cache = None, key = None):
+        """Find the fastest adapter speed that passes check_link.
+
+        The speed is doubled from start until a check fails or limit
+        is reached (or halved until one passes), the edge is then found
+        by bisecting steps times.  The result has to pass a longer
+        check, otherwise the speed is stepped down further.  The speed
+        is set and saved in the speed cache.
+        """
+
+        def ok(khz, rounds = rounds):
+            self.set_speed(khz)
+            r = self.check_link(port, rounds)
+            if self.verbose:
+                print("adapter speed %u kHz: %s" % (khz, r and 'ok' or 'failed'))
+            return r
+
+        good = None
+        bad = None
+        khz = start
+        while khz <= limit:
+            if not ok(khz):
+                bad = khz
+                break
+            good = khz
+            khz *= 2
+
+        if good is None:
+            khz = start // 2
+            while khz and not ok(khz):
+                khz //= 2
+            if not khz:
+                raise IOError("no working adapter speed")
+            good = khz
+
+        for i in range(steps):
+            if bad is None or bad - good <= 1:
+                break
+            khz = (good + bad) // 2
+            if ok(khz):
+                good = khz
+            else:
+                bad = khz
+
+        while not ok(good, rounds * 4):
+            good = good * 3 // 4
+            if not good:
+                raise IOError("no working adapter speed")
+
+        self.set_speed(good)
+        self.save_speed(good, cache, key)
+        return good
+
+    def speed_key(self):
+        return '%s:%s:%08x' % (socket.gethostname(), self.tap, self.idcode)
+
+    def cached_speed(self, cache = None, key = None):
+        if cache is None:
+            cache = os.path.join(CACHE_DIR, 'speed.json')
+        if key is None:
+            key = self.speed_key()
+        return load_json(cache, {}).get(key, {}).get('khz')
+
+    def save_speed(self, khz, cache = None, key = None):
+        if cache is None:
+            cache = os.path.join(CACHE_DIR, 'speed.json')
+        if key is None:
+            key = self.speed_key()
+        speeds = load_json(cache, {})
+        speeds[key] = { 'khz' : khz, 'time' : time.time() }
+        try:
+            save_json(cache, speeds)
+        except OSError as e:
+            print("warning: can't write speed cache: %s" % e)
 
     def highz(self):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_highz))
+        self.ocd.cmd(self.ir_cmd(self.op_highz))
+        self.ir_loaded(self.op_highz)
 
     def flush(self, count = None):
         if count is None:
@@ -326,38 +2046,244 @@ class BS(object):
         data = (1 << self.flushcount) - 1
 
         self.ocd.cmd('irscan %s 0x%x' % (self.tap, data))
+        self.invalidate_ir()
 
     def extest(self, data = 0):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_extest))
-        t = int(self.ocd.cmd('drscan %s %u 0x%x' % (self.tap, self.chainlen, data)), 16)
+        with self.stats.timer('extest', self.chainbytes):
+            t = self.dr_scan(self.op_extest, self.chainlen, data)
         return t
 
     def sample(self, data = 0):
-        self.ocd.cmd('irscan %s 0x%x' % (self.tap, self.op_sample))
-        t = int(self.ocd.cmd('drscan %s %u 0x%x' % (self.tap, self.chainlen, data)), 16)
+        with self.stats.timer('sample', self.chainbytes):
+            t = self.dr_scan(self.op_sample, self.chainlen, data)
         return t
 
-def main():
-    fn = '/opt/Xilinx/14.7/ISE_DS/ISE/xc9500xl/data/xc9572xl_vq64.bsd'
+    def scan_many(self, op, vectors):
+        """Load instruction op and then scan all vectors through the
+        boundary register.  Returns a list with the captured values."""
+
+        vectors = list(vectors)
+        if not vectors:
+            return []
+
+        with self.stats.timer('scan_many', self.chainbytes * len(vectors)):
+            n = self.chainlen
+            irs = self.ir_cmds(op)
+            if not self.tcl:
+                cmds = list(irs)
+                for data in vectors:
+                    cmds.append(self.dr_cmd(n, data))
+                replies = self.ocd.cmd_many(cmds)[len(irs):]
+                self.ir_loaded(op)
+                return [ self.dr_capture(n, int(t, 16)) for t in replies ]
+
+            scanlen = self.dr_value(n, 0)[0]
+            cmds = []
+            for i in range(0, len(vectors), self.scanbatch):
+                if irs and not cmds:
+                    ir = '0x%x' % self.ir_value(op)
+                else:
+                    ir = '-'
+                cmds.append('emu2000_scan %s %s %u {%s}' % (
+                    self.tap, ir, scanlen,
+                    ' '.join([ '0x%x' % self.dr_value(n, data)[1]
+                               for data in vectors[i : i + self.scanbatch] ])))
+            captures = []
+            for reply in self.ocd.cmd_many(cmds):
+                captures.extend([ self.dr_capture(n, int(t, 16))
+                                  for t in reply.split() ])
+            self.ir_loaded(op)
+            assert len(captures) == len(vectors)
+            return captures
+
+    def extest_many(self, vectors):
+        return self.scan_many(self.op_extest, vectors)
+
+    def sample_many(self, vectors):
+        return self.scan_many(self.op_sample, vectors)
+
+class ChainDevice(object):
+    __slots__ = [ 'position', 'idcode', 'fn', 'name', 'irlen', 'ir_offset' ]
+
+    def __init__(self, position, idcode, fn, name, irlen, ir_offset):
+        self.position = position
+        self.idcode = idcode
+        self.fn = fn
+        self.name = name
+        self.irlen = irlen
+        self.ir_offset = ir_offset
+
+class Chain(object):
+    """Model of a JTAG chain with several devices.
+
+    openocd is told about the chain as one TAP with the sum of the
+    instruction register lengths, the devices on it are handled here.
+    A device which is not scanned is put in BYPASS (all ones) and
+    takes one bit of the data register.  Devices are numbered from the
+    TDO end, which is also where their bits start in a scan value.
+
+    The devices are found with discover_chain() unless idcodes is
+    given.  BSDL files are looked up in the BSDL index, fns, packages
+    and irlens can be used to give the file, package or (for a device
+    without a BSDL file) the IR length of a position.
+    """
+
+    def __init__(self, ocd, tap, idcodes = None, fns = {}, packages = {},
+                 irlens = {}, index = None, verbose = 1):
+        self.ocd = ocd
+        self.tap = tap
+        self.verbose = verbose
 
+        if idcodes is None:
+            idcodes = discover_chain(ocd, tap)
+
+        self.devices = []
+        offset = 0
+        for i, idcode in enumerate(idcodes):
+            fn = fns.get(i)
+            name = None
+            irlen = irlens.get(i)
+            if fn is None and irlen is None:
+                if idcode is None:
+                    raise ValueError("device %u has no IDCODE, give its "
+                                     "BSDL file or IR length" % i)
+                if index is None:
+                    index = BsdlIndex()
+                entry = index.find(idcode, packages.get(i))
+                fn, name, irlen = entry['fn'], entry['name'], entry['irlen']
+            elif irlen is None:
+                bsdl = ParsedBsdl(fn)
+                name, irlen = bsdl.name, bsdl.oplen
+            self.devices.append(ChainDevice(i, idcode, fn, name, irlen, offset))
+            offset += irlen
+        self.irlen = offset
+
+        if self.verbose:
+            for dev in self.devices:
+                print("%u: %s irlen %u %s" % (
+                    dev.position,
+                    dev.idcode is None and 'no idcode' or '%08x' % dev.idcode,
+                    dev.irlen, dev.name or ''))
+            print("chain irlen %u" % self.irlen)
+
+        self.tcl = None
+
+    def ir_value(self, ops):
+        """Instruction register value, ops maps a position to an
+        instruction, the other devices get BYPASS."""
+
+        t = (1 << self.irlen) - 1
+        for i, op in ops.items():
+            dev = self.devices[i]
+            t &= ~(((1 << dev.irlen) - 1) << dev.ir_offset)
+            t |= op << dev.ir_offset
+        return t
+
+    def dr_layout(self, lens):
+        """List of (position, offset, length) for a scan where lens maps
+        a position to the length of its selected data register."""
+
+        layout = []
+        offset = 0
+        for dev in self.devices:
+            n = lens.get(dev.position, 1)
+            layout.append((dev.position, offset, n))
+            offset += n
+        return layout
+
+    def pack(self, layout, values):
+        t = 0
+        for i, offset, n in layout:
+            t |= values.get(i, 0) << offset
+        return t
+
+    def unpack(self, layout, regs, t):
+        captures = {}
+        for i, offset, n in layout:
+            if i in regs:
+                captures[i] = (t >> offset) & ((1 << n) - 1)
+        return captures
+
+    def scan_many(self, regs, vectors):
+        """Scan the data registers of several devices together.
+
+        regs maps a position to (instruction, register length), each
+        vector maps a position to the value to shift into its register.
+        All instructions are loaded with one irscan and then every
+        vector is a single drscan through all devices.  Returns a list
+        with a dict of captured values for each vector.
+        """
+
+        if self.tcl is None:
+            self.tcl = load_scan_proc(self.ocd)
+
+        op = self.ir_value(dict([ (i, r[0]) for i, r in regs.items() ]))
+        layout = self.dr_layout(dict([ (i, r[1]) for i, r in regs.items() ]))
+        n = sum([ l[2] for l in layout ])
+        values = [ self.pack(layout, v) for v in vectors ]
+
+        if self.tcl:
+            cmds = []
+            for i in range(0, len(values), 256):
+                cmds.append('emu2000_scan %s 0x%x %u {%s}' % (
+                    self.tap, op, n,
+                    ' '.join([ '0x%x' % t for t in values[i : i + 256] ])))
+            replies = []
+            for reply in self.ocd.cmd_many(cmds):
+                replies.extend(reply.split())
+        else:
+            cmds = [ 'irscan %s 0x%x' % (self.tap, op) ]
+            for t in values:
+                cmds.append('drscan %s %u 0x%x' % (self.tap, n, t))
+            replies = self.ocd.cmd_many(cmds)[1:]
+
+        return [ self.unpack(layout, regs, int(t, 16)) for t in replies ]
+
+    def bs(self, position, verbose = 1, tcl = True):
+        return ChainBS(self, position, verbose, tcl)
+
+class ChainBS(BS):
+    """BS for one device on a Chain, the other devices are in BYPASS."""
+
+    def __init__(self, chain, position, verbose = 1, tcl = True):
+        self.chain = chain
+        self.position = position
+        dev = chain.devices[position]
+        if dev.fn is None:
+            raise ValueError("no BSDL file for device %u" % position)
+
+        # Bypass bits on the TDO and TDI side of the device
+        self.before = position
+        self.after = len(chain.devices) - position - 1
+
+        BS.__init__(self, chain.ocd, chain.tap, dev.fn, verbose, tcl)
+
+        self.bypass_len = len(chain.devices)
+
+    def ir_value(self, op):
+        return self.chain.ir_value({ self.position : op })
+
+    def dr_value(self, n, data):
+        return n + self.before + self.after, data << self.before
+
+    def dr_capture(self, n, t):
+        return (t >> self.before) & ((1 << n) - 1)
+
+def main():
     ocd = OpenOCD()
-    bs = BS(ocd, 'xc.tap', fn)
+    bs = BS(ocd, 'xc.tap', package = 'VQ64')
 
     if 0:
         pprint(bs.bsdl.cells)
         pprint(bs.bsdl.portmaps)
         pprint(bs.bsdl.pinmaps)
 
-    assert len(bs.bsdl.pinmaps) == 1
-    package = list(bs.bsdl.pinmaps.keys())[0]
-    pinmap = bs.bsdl.pinmaps[package]
-    portmap = bs.bsdl.portmaps[package]
-
-    rx_cell = bs.bsdl.cells[pinmap['18']]
-    tx_cell = bs.bsdl.cells[pinmap['19']]
+    dev = bs.device
+    rx = dev.port('18')
+    tx = dev.port('19')
 
-    pprint(rx_cell)
-    pprint(tx_cell)
+    pprint(bs.bsdl.cells[dev.ports[rx]])
+    pprint(bs.bsdl.cells[dev.ports[tx]])
 
     bs.check_idcode()
 
@@ -371,17 +2297,19 @@ def main():
                 sys.stdout.write("\x1b[H\x1b[2J")
                 t0 = t
                 # the OE bit is cleared when sampling, strange
-                wdata |= 1 << rx_cell['oe']
-                wdata ^= 1 << rx_cell['output']
+                wdata |= dev.control_mask[rx]
+                wdata ^= dev.output_mask[rx]
 
             sys.stdout.write("\x1b[H")
 
             rdata = bs.extest(wdata)
-            for k, v in sorted(bs.bsdl.cells.items()):
-                s = "%-10s %4s" % (k, ','.join(portmap[k]))
-                for f in [ 'input', 'output', 'oe', 'oe_disable' ]:
-                    if f in v:
-                        num = v[f]
+            for i, k in enumerate(dev.ports):
+                s = "%-10s %4s" % (k, ','.join(dev.port_pins[i]))
+                for f, cells in [ ('input', dev.input),
+                                  ('output', dev.output),
+                                  ('oe', dev.control) ]:
+                    num = cells[i]
+                    if num >= 0:
                         s += "  %s %4s %4s" % (f, num, (rdata >> num) & 1)
                 print(s)
             t = time.time()
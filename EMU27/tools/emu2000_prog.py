@@ -5,6 +5,12 @@ if __name__ == '__main__':
     if not sys.argv[0]:
         print()
 
+def data_runs(data, blank = 0xff):
+    """Return (start, end) for each run of bytes in data which are not blank."""
+
+    pattern = re.compile(b'[^\\x%02x]+' % blank)
+    return [ m.span() for m in pattern.finditer(bytes(data)) ]
+
 class Prog(object):
     pinmap = {
         'CE'  : '35',
@@ -44,61 +50,150 @@ class Prog(object):
         'TX'  : '19',
     }
 
-    def __init__(self, bs):
+    def __init__(self, bs, batch = 256):
         self.bs = bs
 
+        # update() only queues the output vector, the queue is
+        # scanned with one BS.extest_many call when it is full or
+        # when the captured chain is needed.
+        self.batch = batch
+        self.pending = []
+
+        # Last vector queued and ocd.serial after the last flush.  An
+        # update with the same vector is skipped since it does not
+        # change any pins, unless something else has scanned the
+        # chain in between.
+        self.last = None
+        self.last_serial = None
+
+        # List collecting the vectors instead of scanning them while
+        # compiling, see compile()
+        self.compiled = None
+
         assert len(self.bs.bsdl.pinmaps) == 1
-        package = list(self.bs.bsdl.pinmaps.keys())[0]
-        pinmap = self.bs.bsdl.pinmaps[package]
-        portmap = self.bs.bsdl.portmaps[package]
 
+        # Signal name to port number in the compiled device
+        self.device = bs.device
+        self.ports = {}
         self.portmap = {}
         for k, v in self.pinmap.items():
-            print(k, v, pinmap[v])
-            self.portmap[k] = bs.bsdl.cells[pinmap[v]]
-
-        self.ichain = self.ochain = self.bs.sample()
+            i = self.device.pinmap[v]
+            print(k, v, self.device.ports[i])
+            self.ports[k] = i
+            self.portmap[k] = bs.bsdl.cells[self.device.ports[i]]
+
+        # The output vector with the address, data and control buses
+        # precomputed, bit 0 of the control bus is CE, then OE and WE
+        naddr = len([ k for k in self.pinmap if k.startswith('A') ])
+        self.state = BoundaryState(self.device, {
+            'addr' : [ self.ports['A%u' % i] for i in range(naddr) ],
+            'data' : [ self.ports['D%u' % i] for i in range(8) ],
+            'ctrl' : [ self.ports[k] for k in [ 'CE', 'OE', 'WE' ] ],
+            })
+        self.addr_bus = self.state.buses['addr']
+        self.data_bus = self.state.buses['data']
+        self.ctrl_bus = self.state.buses['ctrl']
+
+        self.encoder = None
+
+        self.captured = self.ochain = self.bs.sample()
         self.bs.sample(self.ochain)
 
         self.prog_unsafe = False
 
+    @property
+    def ochain(self):
+        return self.state.value
+
+    @ochain.setter
+    def ochain(self, value):
+        self.state.value = value
+
     def update(self):
-        self.ichain = self.bs.extest(self.ochain)
+        if self.ochain == self.last and (
+                self.pending or self.compiled is not None or
+                self.last_serial == self.bs.ocd.serial):
+            self.bs.stats.add('scan elided', 0, 0)
+            return
+        self.scan()
+
+    def settle(self):
+        """Scan the current vector again.
+
+        The capture of a scan is taken before its update, so the
+        levels that follow from the last update (like the flash
+        driving the data bus after OE goes low) are only seen by the
+        next scan.  Unlike update() this is never skipped.
+        """
+
+        self.scan()
+
+    def scan(self):
+        self.last = self.ochain
+        if self.compiled is not None:
+            self.compiled.append(self.ochain)
+            return
+        self.pending.append(self.ochain)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def compile(self):
+        """Collect the vectors from update() and settle() in a list
+        instead of scanning them, end_compile() returns the list.
+        Nothing can be read while compiling."""
+
+        self.flush()
+        self.compiled = []
+
+    def end_compile(self):
+        vectors = self.compiled
+        self.compiled = None
+        return vectors
+
+    def flush(self):
+        if self.pending:
+            self.captured = self.bs.extest_many(self.pending)[-1]
+            self.pending = []
+            self.last_serial = self.bs.ocd.serial
+
+    @property
+    def ichain(self):
+        self.flush()
+        return self.captured
 
     def set_pin(self, name, value):
-        port = self.portmap[name]
+        dev = self.device
+        i = self.ports[name]
         if value == None:
-            self.ochain &= ~(1<<port['oe'])
+            self.ochain = (self.ochain & ~dev.control_mask[i]) | dev.disable_bits[i]
 
         else:
-            self.ochain |= (1<<port['oe'])
-
+            t = self.ochain & ~(dev.control_mask[i] | dev.output_mask[i])
+            t |= dev.enable_bits[i]
             if value:
-                self.ochain |= (1<<port['output'])
-            else:
-                self.ochain &= ~(1<<port['output'])
+                t |= dev.output_mask[i]
+            self.ochain = t
 
     def get_pin(self, name):
-        port = self.portmap[name]
-        return (self.ichain >> port['input']) & 1
+        return (self.ichain >> self.device.input[self.ports[name]]) & 1
 
     def set_addr(self, addr):
-        for i in range(19):
-            self.set_pin('A%u' % i, (addr >> i) & 1)
+        state = self.state
+        state.value = self.addr_bus.set(state.value, addr)
 
     def set_data(self, data):
-        for i in range(8):
-            if data is None:
-                self.set_pin('D%u' % i, None)
-            else:
-                self.set_pin('D%u' % i, (data >> i) & 1)
+        state = self.state
+        if data is None:
+            state.value = self.data_bus.release(state.value)
+        else:
+            state.value = self.data_bus.set(state.value, data)
 
     def get_data(self):
-        data = 0
-        for i in range(8):
-            if self.get_pin('D%u' % i):
-                data |= 1 << i
-        return data
+        return self.data_bus.get(self.ichain)
+
+    def set_ctrl(self, ce, oe, we):
+        state = self.state
+        state.value = self.ctrl_bus.set(state.value, ce | (oe << 1) | (we << 2))
 
     def set_ce(self, value):
         self.set_pin('CE', value)
@@ -114,37 +209,130 @@ class Prog(object):
         self.set_data(data)
         self.update()
 
-        self.set_ce(0)
-        self.set_oe(1)
-        self.set_we(0)
+        self.set_ctrl(ce = 0, oe = 1, we = 0)
         self.update()
 
-        self.set_ce(1)
-        self.set_we(1)
+        self.set_ctrl(ce = 1, oe = 1, we = 1)
         self.update()
 
         if 0:
             self.set_data(None)
             self.update()
 
-    def read(self, addr):
+    def read_cycle(self, addr):
+        """Start a read cycle, the capture of the last scan has the data."""
+
         self.set_addr(addr)
         self.set_data(None)
         self.update()
-        self.set_ce(0)
-        self.set_oe(0)
-        self.set_we(1)
+        self.set_ctrl(ce = 0, oe = 0, we = 1)
         self.update()
+        self.settle()
+
+    def read_sequence(self, addr, n):
+        """Compile reads of n bytes starting at addr, one scan per byte.
+
+        CE and OE stay low and each scan drives the next address while
+        it captures the data for the address before it.  Returns the
+        index of the vector whose capture has each byte.
+        """
+
+        if not n:
+            return []
+
+        # Let go of the data bus before the flash starts driving it
+        self.set_data(None)
+        self.update()
+
+        self.set_ctrl(ce = 0, oe = 0, we = 1)
+        reads = []
+        for i in range(n):
+            self.set_addr(addr + i)
+            self.settle()
+            reads.append(len(self.compiled))
+        self.set_ctrl(ce = 1, oe = 1, we = 1)
         self.update()
+        return reads
+
+    def read_block(self, addr, n, chunk = 4096):
+        """Read n bytes starting at addr, returns bytes."""
+
+        data = bytearray(n)
+        get = self.data_bus.get
+        for start in range(0, n, chunk):
+            self.compile()
+            reads = self.read_sequence(addr + start, min(chunk, n - start))
+            captures = self.scan_vectors(self.end_compile())
+            for i, k in enumerate(reads):
+                data[start + i] = get(captures[k])
+        return bytes(data)
+
+    def read(self, addr):
+        self.read_cycle(addr)
 
         data = self.get_data()
 
-        self.set_ce(1)
-        self.set_oe(1)
+        self.set_ctrl(ce = 1, oe = 1, we = 1)
         self.update()
 
         return data
 
+    # Maximum byte program time of the SST39SF0x0A
+    PROGRAM_TIME = 20e-6
+
+    # Sector size of the SST39SF0x0A, the smallest unit that can be erased
+    SECTOR_SIZE = 4096
+
+    # Values of the control bus, bit 0 is CE, then OE and WE
+    CTRL_IDLE = 7
+    CTRL_WRITE = 2
+    CTRL_READ = 4
+
+    def scan_vectors(self, vectors):
+        """Scan a list of vectors after the queued ones, returns the
+        captured values and leaves the last vector as the current one."""
+
+        self.flush()
+        captures = self.bs.extest_many(vectors)
+        self.ochain = self.last = vectors[-1]
+        self.captured = captures[-1]
+        self.last_serial = self.bs.ocd.serial
+        return captures
+
+    def get_encoder(self):
+        if self.encoder is None:
+            self.encoder = BatchEncoder(self.state)
+        return self.encoder
+
+    def write_many(self, addrs, datas):
+        """Do a write cycle for every address and data byte, the
+        vectors are built with NumPy in one go."""
+
+        enc = self.get_encoder()
+        np = enc.np
+        n = len(addrs)
+        ctrl = np.tile([ self.CTRL_IDLE, self.CTRL_WRITE, self.CTRL_IDLE ], n)
+        self.scan_vectors(enc.encode(self.ochain, {
+            'addr' : np.repeat(addrs, 3),
+            'data' : np.repeat(datas, 3),
+            'ctrl' : ctrl }))
+
+    def read_many(self, addrs):
+        """Do a read cycle for every address, returns a NumPy array
+        with the data read."""
+
+        enc = self.get_encoder()
+        np = enc.np
+        n = len(addrs)
+        ctrl = np.tile([ self.CTRL_IDLE, self.CTRL_READ,
+                         self.CTRL_READ, self.CTRL_IDLE ], n)
+        captures = self.scan_vectors(enc.encode(self.ochain, {
+            'addr' : np.repeat(addrs, 4),
+            'data' : np.full(4 * n, -1),
+            'ctrl' : ctrl }))
+        # The third scan of each cycle sees the flash driving the bus
+        return enc.decode(captures[2::4], 'data')
+
     def dump(self):
         s = ''
         for name, port in self.portmap.items():
@@ -175,6 +363,9 @@ class Prog(object):
         self.write(  addr, data)
 
         if self.prog_unsafe:
+            # Don't poll, wait for the program time like program_block
+            for i in range(self.program_wait()):
+                self.settle()
             return
 
         while True:
@@ -182,6 +373,85 @@ class Prog(object):
             if v == data:
                 break
 
+    def program_wait(self):
+        """Number of extra scans to wait after a byte program command.
+
+        The next cycle has OE or WE low on its second scan, before
+        that the byte program time must have passed.  The time for a
+        scan is the TCK time for the bits shifted, the real time is
+        longer, so this is on the safe side.  An unknown adapter speed
+        is taken to be the highest one calibrate() tries.
+        """
+
+        khz = self.bs.speed or 32000
+        bits = self.bs.dr_value(self.bs.chainlen, 0)[0] + 6
+        scan_time = bits / (khz * 1000.0)
+        return max(0, int(math.ceil(self.PROGRAM_TIME / scan_time)) - 1)
+
+    def program_block(self, addr, data, verify = True, chunk = 256,
+                      sparse = False):
+        """Program data starting at addr.
+
+        The unlock and program cycles for chunk bytes at a time are
+        compiled to vectors and sent in one batch, with a fixed number
+        of scans after each byte to cover the program time instead of
+        polling.  With verify, read cycles for the bytes are added to
+        the same batch and the list of addresses which do not read
+        back correctly is returned.
+
+        With sparse, bytes which are 0xff are skipped, this assumes
+        that the flash has been erased.  The skipped bytes are not
+        read back either, they are taken to be blank.
+        """
+
+        if sparse:
+            runs = data_runs(data)
+        else:
+            runs = [ (0, len(data)) ]
+
+        # Split the runs into pieces of at most chunk bytes and group
+        # the pieces into batches of at most chunk bytes
+        batches = [ [] ]
+        size = 0
+        for start, end in runs:
+            for i in range(start, end, chunk):
+                n = min(chunk, end - i)
+                if size + n > chunk:
+                    batches.append([])
+                    size = 0
+                batches[-1].append((i, n))
+                size += n
+
+        wait = self.program_wait()
+        bad = []
+        for batch in batches:
+            if not batch:
+                continue
+
+            self.compile()
+            for start, n in batch:
+                for i in range(start, start + n):
+                    self.write(0x5555, 0xaa)
+                    self.write(0x2aaa, 0x55)
+                    self.write(0x5555, 0xa0)
+                    self.write(addr + i, data[i])
+                    for j in range(wait):
+                        self.settle()
+
+            reads = []
+            if verify:
+                for start, n in batch:
+                    reads += [ (start + i, v) for i, v in enumerate(
+                        self.read_sequence(addr + start, n)) ]
+
+            captures = self.scan_vectors(self.end_compile())
+
+            for i, v in reads:
+                if self.data_bus.get(captures[v]) != data[i]:
+                    bad.append(addr + i)
+
+        return bad
+
     def chip_erase(self):
         self.write(0x5555, 0xaa)
         self.write(0x2aaa, 0x55)
@@ -203,20 +473,106 @@ class Prog(object):
         self.write(0x2aaa, 0x55)
         self.write(  addr, 0x30)
 
+        # Data# polling only works inside the sector being erased
         while True:
-            v = self.read(0x0000)
+            v = self.read(addr)
             if v & 0x80:
                 break
 
-def main():
-    fn = '/opt/Xilinx/14.7/ISE_DS/ISE/xc9500xl/data/xc9572xl_vq64.bsd'
+    def program_diff(self, addr, data, current = None, verify = True):
+        """Reprogram only the sectors where data differs from the flash.
+
+        current is what the flash is known to contain starting at
+        addr, if it is None the flash is read back.  data is padded
+        with 0xff to a whole number of sectors, and so is current.
+        Each changed sector is erased and programmed again, the flash
+        must be erased before a byte is programmed.
+
+        Returns the erased sectors and the list of addresses which did
+        not verify.
+        """
+
+        assert addr % self.SECTOR_SIZE == 0
+
+        n = -(-len(data) // self.SECTOR_SIZE) * self.SECTOR_SIZE
+        data = bytes(data) + b'\xff' * (n - len(data))
+        if current is None:
+            current = self.read_block(addr, n)
+        current = bytes(current[:n]) + b'\xff' * (n - len(current))
+
+        erased = []
+        bad = []
+        for start in range(0, n, self.SECTOR_SIZE):
+            end = start + self.SECTOR_SIZE
+            if current[start:end] == data[start:end]:
+                continue
+
+            self.sector_erase(addr + start)
+            erased.append(addr + start)
+
+            bad += self.program_block(addr + start, data[start:end],
+                                      verify = verify, sparse = True)
+
+        return erased, bad
 
-    ocd = OpenOCD()
-    ocd.cmd('adapter speed 1000')
-    bs = BS(ocd, 'xc.tap', fn)
+def main():
+    parser = argparse.ArgumentParser()
+    add_openocd_args(parser)
+    add_bsdl_args(parser)
+    parser.add_argument('--stats',
+                        help = "write timing statistics as JSON to this file")
+    parser.add_argument('--speed', type = int,
+                        help = "adapter speed in kHz, default is the "
+                        "calibrated speed for this board or 1000")
+    parser.add_argument('--calibrate', action = 'store_true',
+                        help = "find and cache the fastest reliable adapter speed")
+    parser.add_argument('--chain', type = int, metavar = 'POSITION',
+                        help = "discover the devices on the JTAG chain and use "
+                        "the CPLD at this position (counted from TDO)")
+    parser.add_argument('--irlen', action = 'append', default = [],
+                        metavar = 'POSITION:LENGTH',
+                        help = "IR length of a device on the chain which "
+                        "has no BSDL file")
+    parser.add_argument('--image',
+                        help = "program this file instead of the test data")
+    parser.add_argument('--no-sparse', action = 'store_true',
+                        help = "program the 0xff bytes in the image too")
+    parser.add_argument('--diff', action = 'store_true',
+                        help = "only erase and program the sectors which "
+                        "differ from what is in the flash")
+    parser.add_argument('--known',
+                        help = "with --diff, a file with the current flash "
+                        "contents instead of reading them back")
+    args = parser.parse_args()
+
+    phases = Stats()
+
+    ocd = open_openocd(args)
+    if args.chain is not None:
+        fns = {}
+        if args.bsdl:
+            fns[args.chain] = args.bsdl
+        irlens = dict([ [ int(v, 0) for v in s.split(':') ]
+                        for s in args.irlen ])
+        chain = Chain(ocd, 'xc.tap', fns = fns, irlens = irlens,
+                      packages = { args.chain : args.package })
+        bs = chain.bs(args.chain)
+    else:
+        bs = BS(ocd, 'xc.tap', args.bsdl, package = args.package)
 
     prog = Prog(bs)
 
+    if args.calibrate:
+        speed = bs.calibrate(prog.portmap['RX']['name'])
+    elif args.replay:
+        # The speed in the recording, not the one cached on this host
+        speed = ocd.recorded('speed', args.speed or 1000)
+        bs.set_speed(speed)
+    else:
+        speed = args.speed or bs.cached_speed() or 1000
+        bs.set_speed(speed)
+    print("adapter speed %u kHz" % speed)
+
     bs.check_idcode()
     bs.check_usercode()
 
@@ -228,18 +584,14 @@ def main():
 
     print("flash id: %04x" % prog.software_id())
 
-    prog.prog_unsafe = 1
-
     if 1:
-        print("chip erase")
-        prog.chip_erase()
-        # prog.sector_erase(0)
-
-        # prog.prog_byte(0x0007, 0x42)
-
         n = 256
 
-        if 0:
+        if args.image:
+            with open(args.image, 'rb') as f:
+                data = bytearray(f.read())
+            n = len(data)
+        elif 0:
             data = bytearray(range(0, n))
         else:
             data = bytearray(range(n-1, -1, -1))
@@ -248,28 +600,54 @@ def main():
                 hello = 'Hello World!\r\n'.encode('ascii')
                 data = hello + data[len(hello):]
 
-        if 1:
-            t0 = time.time()
-            for i in range(n):
-                v = prog.read(i)
-                assert v == 0xff
-            t = time.time()
-            print("Elapsed for empty check of %u bytes: %.3f" % (n, t-t0))
+    if args.diff:
+        current = None
+        if args.known:
+            with open(args.known, 'rb') as f:
+                current = f.read()
+
+        with phases.timer('diff', n) as t:
+            erased, bad = prog.program_diff(0, data, current)
+        print("Elapsed for diff of %u bytes: %.3f" % (n, t.elapsed))
+        print("%u sectors erased and programmed" % len(erased))
+        assert not bad, ' '.join([ '%05x' % a for a in bad ])
+
+    else:
+        print("chip erase")
+        prog.chip_erase()
+        # prog.sector_erase(0)
+
+        # prog.prog_byte(0x0007, 0x42)
 
         if 1:
-            t0 = time.time()
-            for i in range(n):
-                prog.prog_byte(i, data[i])
-            t = time.time()
-            print("Elapsed for write of %u bytes: %.3f" % (n, t-t0))
+            with phases.timer('empty check', n) as t:
+                v = prog.read_block(0, n)
+                assert v == b'\xff' * n
+            print("Elapsed for empty check of %u bytes: %.3f" % (n, t.elapsed))
 
         if 1:
-            t0 = time.time()
-            for i in range(n):
-                v = prog.read(i)
-                assert v == data[i]
-            t = time.time()
-            print("Elapsed for verify of %u bytes: %.3f" % (n, t-t0))
+            with phases.timer('write', n) as t:
+                prog.program_block(0, data, verify = False,
+                                   sparse = not args.no_sparse)
+            print("Elapsed for write of %u bytes: %.3f" % (n, t.elapsed))
+            if not args.no_sparse:
+                runs = data_runs(data)
+                m = sum([ end - start for start, end in runs ])
+                print("%u bytes in %u runs programmed, %u blank bytes skipped" % (
+                    m, len(runs), n - m))
+
+    if 1:
+        # After a sparse write the skipped bytes passed the empty check
+        if args.diff or args.no_sparse:
+            runs = [ (0, n) ]
+        else:
+            runs = data_runs(data)
+        m = sum([ end - start for start, end in runs ])
+        with phases.timer('verify', m) as t:
+            for start, end in runs:
+                v = prog.read_block(start, end - start)
+                assert v == bytes(data[start:end]), "verify failed at %05x" % start
+        print("Elapsed for verify of %u bytes: %.3f" % (m, t.elapsed))
 
     print()
     for i in range(10):
@@ -278,6 +656,7 @@ def main():
     # print(prog.dump())
 
     # Back to normal mode
+    prog.flush()
     bs.sample()
 
     bs.bypass()
@@ -304,11 +683,24 @@ def main():
             sys.stdout.write("\x1b[H")
 
             prog.update()
-            prog.update()
+            prog.settle()
             for name in prog.portmap.keys():
                 print("%-4s %u" % (name, prog.get_pin(name)))
 
             print(v)
 
+    if args.stats:
+        print()
+        print(phases.report())
+        print(bs.stats.report())
+        print(ocd.stats.report())
+        with open(args.stats, 'w') as f:
+            json.dump({ 'phases' : phases.as_dict(),
+                        'bs' : bs.stats.as_dict(),
+                        'openocd' : ocd.stats.as_dict() },
+                      f, indent = 4)
+
+    ocd.close()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,628 @@
+#! /usr/bin/python3
+"""Simulated emulator board which talks the openocd Tcl protocol.
+
+The CPLD is modelled from its BSDL file, the pins in Prog.pinmap are
+wired to a model of a JEDEC flash chip (SST39SF0x0 style command set
+with data polling).  Time is simulated, each scan advances the clock
+by the number of TCK cycles it takes at the current adapter speed, so
+runs are repeatable and flash timing is checked the same way as on
+real hardware.
+
+Start it and point the other tools at it:
+
+    ./emu2000_sim.py --port 6666 &
+    ./emu2000_prog.py --port 6666
+"""
+
+from emu2000_lib import *
+from emu2000_prog import Prog
+
+import random
+import threading
+import socketserver
+
+if __name__ == '__main__':
+    if not sys.argv[0]:
+        print()
+
+class Flash(object):
+    # Worst case times from the SST39SF010A/020A/040 data sheet
+    BYTE_PROGRAM_TIME = 20e-6
+    SECTOR_ERASE_TIME = 25e-3
+    CHIP_ERASE_TIME = 100e-3
+
+    def __init__(self, size = 256 * 1024, sector_size = 4096,
+                 vendor = 0xbf, device = 0xb6):
+        self.size = size
+        self.sector_size = sector_size
+        self.vendor = vendor
+        self.device = device
+
+        self.mem = bytearray(b'\xff') * size
+
+        self.state = 'idle'
+        self.idmode = False
+
+        # Operation in progress, None or (end time, op, addr, data)
+        self.busy = None
+        self.toggle = 0
+
+        self.ce = self.oe = self.we = 1
+
+        # Statistics
+        self.programmed = 0
+        self.erased = 0
+
+    def finish(self, now):
+        if self.busy is None or now < self.busy[0]:
+            return
+        t, op, addr, data = self.busy
+        if op == 'program':
+            self.mem[addr] &= data
+            self.programmed += 1
+        elif op == 'sector':
+            addr -= addr % self.sector_size
+            self.mem[addr : addr + self.sector_size] = b'\xff' * self.sector_size
+            self.erased += 1
+        elif op == 'chip':
+            self.mem[:] = b'\xff' * self.size
+            self.erased += 1
+        self.busy = None
+
+    def update(self, now, ce, oe, we, addr, data):
+        """Called with the levels on the flash pins, returns the value
+        the flash drives on the data bus or None."""
+
+        self.finish(now)
+
+        addr &= self.size - 1
+
+        # A write cycle ends at the first rising edge of CE or WE
+        if not self.ce and not self.we and (ce or we):
+            self.write(now, addr, data)
+
+        # The toggle bit changes for every new read cycle
+        reading = not ce and not oe and we
+        if reading and (self.ce or self.oe or not self.we):
+            self.toggle ^= 0x40
+
+        self.ce, self.oe, self.we = ce, oe, we
+
+        if not reading:
+            return None
+        return self.read(now, addr)
+
+    def read(self, now, addr):
+        if self.busy is not None:
+            # Data# polling and toggle bit
+            t, op, busy_addr, data = self.busy
+            if op == 'program':
+                return (~data & 0x80) | self.toggle
+            return self.toggle
+
+        if self.idmode:
+            if addr & 1:
+                return self.device
+            return self.vendor
+
+        return self.mem[addr]
+
+    def write(self, now, addr, data):
+        if self.busy is not None:
+            return
+
+        cmd = (addr & 0x7fff, data)
+        state = self.state
+        self.state = 'idle'
+
+        if state == 'idle':
+            if cmd == (0x5555, 0xaa):
+                self.state = 'unlock1'
+            elif data == 0xf0:
+                self.idmode = False
+
+        elif state == 'unlock1':
+            if cmd == (0x2aaa, 0x55):
+                self.state = 'unlock2'
+
+        elif state == 'unlock2':
+            if cmd == (0x5555, 0xa0):
+                self.state = 'program'
+            elif cmd == (0x5555, 0x80):
+                self.state = 'erase'
+            elif cmd == (0x5555, 0x90):
+                self.idmode = True
+            elif cmd == (0x5555, 0xf0):
+                self.idmode = False
+
+        elif state == 'program':
+            self.busy = (now + self.BYTE_PROGRAM_TIME, 'program', addr, data)
+
+        elif state == 'erase':
+            if cmd == (0x5555, 0xaa):
+                self.state = 'erase1'
+
+        elif state == 'erase1':
+            if cmd == (0x2aaa, 0x55):
+                self.state = 'erase2'
+
+        elif state == 'erase2':
+            if cmd == (0x5555, 0x10):
+                self.busy = (now + self.CHIP_ERASE_TIME, 'chip', addr, data)
+            elif data == 0x30:
+                self.busy = (now + self.SECTOR_ERASE_TIME, 'sector', addr, data)
+
+class Tap(object):
+    """Another device on the JTAG chain with only IDCODE and BYPASS."""
+
+    def __init__(self, idcode, irlen):
+        self.idcode = idcode
+        self.oplen = irlen
+        self.op_idcode = 1
+        self.reset_tap()
+
+    def reset_tap(self):
+        if self.idcode is None:
+            self.ir = (1 << self.oplen) - 1
+        else:
+            self.ir = self.op_idcode
+
+    def set_ir(self, value):
+        self.ir = value & ((1 << self.oplen) - 1)
+
+    def register(self):
+        if self.ir == self.op_idcode and self.idcode is not None:
+            return 32, self.idcode
+        return 1, 0
+
+    def update_register(self, reg):
+        pass
+
+class Board(object):
+    """The CPLD TAP with its boundary register wired to the flash."""
+
+    def __init__(self, bsdl, flash, pinmap = Prog.pinmap,
+                 khz = 1000, max_khz = None, seed = 0):
+        self.bsdl = bsdl
+        self.flash = flash
+
+        self.oplen = bsdl.oplen
+        self.chainlen = bsdl.chainlen
+        self.opcodes = bsdl.opcodes
+        self.op_extest = self.opcodes['EXTEST']
+        self.op_idcode = self.opcodes['IDCODE']
+
+        self.idcode = bsdl.idcode & bsdl.idmask
+        self.usercode = 0xffffffff
+
+        assert len(bsdl.pinmaps) == 1
+        package = list(bsdl.pinmaps.keys())[0]
+        pins = bsdl.pinmaps[package]
+
+        # Boundary cells for the CPLD ports the flash is connected to
+        self.signals = {}
+        for name, pin in pinmap.items():
+            self.signals[name] = bsdl.cells[pins[pin]]
+        self.addr_bits = len([ name for name in self.signals
+                               if name.startswith('A') ])
+
+        self.ir = self.op_idcode
+        self.bsr = 0
+
+        # Simulated time in seconds and the TCK frequency
+        self.now = 0.0
+        self.khz = khz
+
+        # Above max_khz scans are corrupted, used to test adapter
+        # speed calibration
+        self.max_khz = max_khz
+        self.random = random.Random(seed)
+
+        self.scans = 0
+        self.contention = 0
+
+        self.procs = {}
+
+        # Devices on the JTAG chain starting from TDO, the CPLD is one
+        # of them
+        self.taps = [ self ]
+
+    def clock(self, cycles):
+        self.now += cycles / (self.khz * 1000.0)
+
+    def drive(self, cell):
+        """Value the CPLD drives on a port or None if it is tristated."""
+
+        if self.ir != self.op_extest:
+            return None
+        if 'output' in cell:
+            if (self.bsr >> cell['oe']) & 1 == cell['oe_disable_value']:
+                return None
+            return (self.bsr >> cell['output']) & 1
+        if 'io' in cell:
+            if (self.bsr >> cell['dir']) & 1 == cell['dir_disable_value']:
+                return None
+            return (self.bsr >> cell['io']) & 1
+        return None
+
+    def evaluate(self):
+        """Return a dict with the level on every CPLD port."""
+
+        driven = {}
+        for name, cell in self.bsdl.cells.items():
+            driven[name] = self.drive(cell)
+
+        def level(signal):
+            v = driven[self.signals[signal]['name']]
+            if v is None:
+                return 1
+            return v
+
+        addr = 0
+        for i in range(self.addr_bits):
+            addr |= level('A%u' % i) << i
+        data = 0
+        for i in range(8):
+            data |= level('D%u' % i) << i
+
+        out = self.flash.update(self.now, level('CE'), level('OE'),
+                                level('WE'), addr, data)
+
+        levels = {}
+        for name, v in driven.items():
+            levels[name] = v
+        if out is not None:
+            for i in range(8):
+                name = self.signals['D%u' % i]['name']
+                if levels[name] is not None:
+                    self.contention += 1
+                else:
+                    levels[name] = (out >> i) & 1
+        for name, v in levels.items():
+            if v is None:
+                levels[name] = 1
+        return levels
+
+    def capture(self):
+        levels = self.evaluate()
+        t = 0
+        for name, cell in self.bsdl.cells.items():
+            if 'input' in cell:
+                t |= levels[name] << cell['input']
+            elif 'io' in cell:
+                t |= levels[name] << cell['io']
+        return t
+
+    def corrupt(self, value, n):
+        if self.max_khz is None or self.khz <= self.max_khz:
+            return value
+        if self.random.random() < (self.khz - self.max_khz) / self.max_khz:
+            value ^= 1 << self.random.randrange(n)
+        return value
+
+    def reset_tap(self):
+        self.ir = self.op_idcode
+        self.evaluate()
+
+    def set_ir(self, value):
+        self.ir = value & ((1 << self.oplen) - 1)
+
+    def register(self):
+        """Length and captured value of the selected data register."""
+
+        if self.ir == self.op_idcode:
+            return 32, self.idcode
+        if self.ir == self.opcodes.get('USERCODE'):
+            return 32, self.usercode
+        if self.ir in (self.opcodes['EXTEST'], self.opcodes['SAMPLE'],
+                       self.opcodes.get('INTEST')):
+            return self.chainlen, self.capture()
+        return 1, 0
+
+    def update_register(self, reg):
+        if self.ir in (self.opcodes['EXTEST'], self.opcodes['SAMPLE'],
+                       self.opcodes.get('INTEST')):
+            self.bsr = reg
+            self.evaluate()
+
+    # Scans of the whole chain, the instruction and data registers of
+    # the devices on it are concatenated starting from the TDO end
+
+    def irscan(self, value):
+        self.clock(sum([ tap.oplen for tap in self.taps ]) + 8)
+        for tap in self.taps:
+            tap.set_ir(value)
+            value >>= tap.oplen
+        self.evaluate()
+
+    def drscan(self, n, value):
+        regs = [ tap.register() for tap in self.taps ]
+        reglen = 0
+        capture = 0
+        for l, c in regs:
+            capture |= c << reglen
+            reglen += l
+
+        self.clock(n + 6)
+        self.scans += 1
+
+        # What comes out on TDO is the captured register followed by
+        # the bits shifted in, what is left in the register is the
+        # last reglen bits shifted in.
+        t = capture | (value << reglen)
+        out = t & ((1 << n) - 1)
+        reg = (t >> n) & ((1 << reglen) - 1)
+
+        for tap, (l, c) in zip(self.taps, regs):
+            tap.update_register(reg & ((1 << l) - 1))
+            reg >>= l
+
+        return self.corrupt(out, n)
+
+    def scan_many(self, op, n, vectors):
+        if op is not None:
+            self.irscan(op)
+        return [ self.drscan(n, v) for v in vectors ]
+
+    def command(self, line):
+        words = tcl_split(line)
+        if not words:
+            return ''
+
+        cmd = words[0]
+
+        if cmd == 'irscan':
+            self.irscan(parse_value(words[2]))
+            return ''
+
+        if cmd == 'drscan':
+            fields = []
+            value = 0
+            n = 0
+            for i in range(2, len(words) - 1, 2):
+                if words[i].startswith('-'):
+                    break
+                bits = int(words[i], 10)
+                value |= parse_value(words[i + 1]) << n
+                fields.append(bits)
+                n += bits
+            out = self.drscan(n, value)
+            replies = []
+            for bits in fields:
+                replies.append(hex_value(out & ((1 << bits) - 1), bits))
+                out >>= bits
+            return ' '.join(replies)
+
+        if cmd == 'emu2000_scan' and cmd in self.procs:
+            tap, op, n, vectors = words[1:]
+            n = int(n, 10)
+            if op == '-':
+                op = None
+            else:
+                op = parse_value(op)
+            captures = self.scan_many(op, n,
+                                      [ parse_value(v) for v in vectors.split() ])
+            return ' '.join([ hex_value(t, n) for t in captures ])
+
+        if cmd == 'proc':
+            self.procs[words[1]] = words[3]
+            return ''
+
+        if cmd == 'info' and words[1:2] == [ 'procs' ]:
+            return ' '.join([ name for name in self.procs
+                              if name in words[2:] ])
+
+        if cmd == 'adapter' and words[1:2] == [ 'speed' ]:
+            if len(words) > 2:
+                self.khz = int(words[2], 10)
+            return 'adapter speed: %u kHz' % self.khz
+
+        if cmd == 'sleep':
+            self.now += int(words[1], 10) / 1000.0
+            self.evaluate()
+            return ''
+
+        if cmd == 'runtest':
+            self.clock(int(words[1], 10))
+            self.evaluate()
+            return ''
+
+        if cmd == 'pathmove':
+            if 'RESET' in words:
+                for tap in self.taps:
+                    tap.reset_tap()
+            return ''
+
+        if cmd in ('init', 'echo'):
+            return ''
+
+        return 'invalid command name "%s"' % cmd
+
+def tcl_split(line):
+    """Split a Tcl command into words, enough for the commands above."""
+
+    words = []
+    i = 0
+    n = len(line)
+    while i < n:
+        if line[i].isspace():
+            i += 1
+            continue
+        if line[i] == '{':
+            depth = 1
+            j = i + 1
+            while depth:
+                if line[j] == '{':
+                    depth += 1
+                elif line[j] == '}':
+                    depth -= 1
+                j += 1
+            words.append(line[i + 1 : j - 1])
+            i = j
+            continue
+        j = i
+        while j < n and not line[j].isspace():
+            j += 1
+        words.append(line[i:j])
+        i = j
+    return words
+
+def parse_value(s):
+    if s[:2].lower() == '0x':
+        return int(s[2:], 16)
+    return int(s, 10)
+
+def hex_value(value, bits):
+    return '%0*x' % ((bits + 3) // 4, value)
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        buf = bytearray()
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            buf += data
+
+            # Answer everything that has arrived with a single send
+            replies = []
+            while True:
+                i = buf.find(OpenOCD.EOM)
+                if i == -1:
+                    break
+                line = buf[:i].decode('ascii')
+                del buf[:i+1]
+                with server.lock:
+                    reply = server.board.command(line)
+                if server.verbose:
+                    print("> %s" % line)
+                    print("< %s" % reply)
+                replies.append(reply.encode('ascii') + OpenOCD.EOM)
+
+            if replies:
+                if server.latency:
+                    time.sleep(server.latency)
+                self.request.sendall(b''.join(replies))
+
+def serve_pipe(board, rfd = 0, wfd = 1, verbose = 0):
+    """Serve the Tcl protocol on a pair of file descriptors the way
+    openocd does with "tcl_port pipe".  Like openocd every reply is
+    written before the next command is read."""
+
+    buf = bytearray()
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break
+        buf += data
+
+        while True:
+            i = buf.find(OpenOCD.EOM)
+            if i == -1:
+                break
+            line = buf[:i].decode('ascii')
+            del buf[:i+1]
+            reply = board.command(line)
+            if verbose:
+                print("> %s" % line)
+                print("< %s" % reply)
+            view = memoryview(reply.encode('ascii') + OpenOCD.EOM)
+            while view:
+                view = view[os.write(wfd, view):]
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, board, host = '127.0.0.1', port = 6666,
+                 latency = 0, verbose = 0):
+        self.board = board
+        self.lock = threading.Lock()
+
+        # Extra delay per reply to mimic a slow network
+        self.latency = latency
+
+        self.verbose = verbose
+        super(Server, self).__init__((host, port), Handler)
+
+    def start(self):
+        """Serve from a background thread, used from benchmarks and tests."""
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 6666)
+    add_bsdl_args(parser)
+    parser.add_argument('--idcode', type = lambda s: int(s, 0), default = 0x09604093,
+                        help = "IDCODE used to look up the BSDL file, "
+                        "default is the XC9572XL")
+    parser.add_argument('--image',
+                        help = "initial contents of the flash")
+    parser.add_argument('--chain', default = 'cpld',
+                        help = "devices on the JTAG chain from TDO, separated "
+                        "by commas, 'cpld' or IDCODE:IRLEN (IDCODE may be "
+                        "'none' for a device without one)")
+    parser.add_argument('--size', type = int, default = 256 * 1024,
+                        help = "size of the flash in bytes")
+    parser.add_argument('--max-khz', type = int,
+                        help = "corrupt scans above this adapter speed")
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = "extra delay in seconds for each reply")
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+
+    # Accept the options PipeTransport starts openocd with
+    parser.add_argument('-c', dest = 'commands', action = 'append', default = [],
+                        help = "openocd command, only \"tcl_port pipe\" is "
+                        "used: serve on stdin/stdout to stand in for openocd")
+    parser.add_argument('-s', help = "ignored")
+    parser.add_argument('-f', help = "ignored")
+    args = parser.parse_args()
+
+    pipe = 'tcl_port pipe' in args.commands
+    if pipe:
+        # stdout carries the protocol
+        sys.stdout = sys.stderr
+
+    flash = Flash(args.size)
+    if args.image:
+        with open(args.image, 'rb') as f:
+            data = f.read()
+        flash.mem[:len(data)] = data
+
+    if args.bsdl:
+        bsdl = ParsedBsdl(args.bsdl)
+    else:
+        bsdl = ParsedBsdl.from_idcode(args.idcode, args.package)
+    board = Board(bsdl, flash, max_khz = args.max_khz)
+    board.taps = []
+    for dev in args.chain.split(','):
+        if dev == 'cpld':
+            board.taps.append(board)
+        else:
+            idcode, irlen = dev.split(':')
+            idcode = None if idcode == 'none' else int(idcode, 0)
+            board.taps.append(Tap(idcode, int(irlen, 0)))
+
+    try:
+        if pipe:
+            serve_pipe(board, verbose = args.verbose)
+        else:
+            server = Server(board, args.host, args.port,
+                            latency = args.latency, verbose = args.verbose)
+            print("listening on %s:%s" % (args.host, args.port))
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("simulated time %.3f s, %u scans, %u bytes programmed, %u erases" % (
+        board.now, board.scans, flash.programmed, flash.erased))
+    if board.contention:
+        print("warning: %u scans with bus contention" % board.contention)
+
+if __name__ == '__main__':
+    main()
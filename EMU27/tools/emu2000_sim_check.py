@@ -0,0 +1,204 @@
+#! /usr/bin/python3
+"""Check Prog against the simulated board.
+
+Starts the simulator in this process on a free port, then erases,
+programs and reads back the flash through openocd Tcl commands the way
+emu2000_prog.py does and compares the result with the flash model.
+Also checks the NumPy batch encoder against BoundaryState (skipped
+without NumPy), AsyncOpenOCD, and a run over a pipe with the simulator
+standing in for openocd.
+Exits with status 1 if anything does not match, so it can be run from
+CI without any hardware.
+"""
+
+from emu2000_lib import *
+from emu2000_prog import Prog
+from emu2000_sim import Flash, Board, Server
+
+import asyncio
+import random
+
+if __name__ == '__main__':
+    if not sys.argv[0]:
+        print()
+
+def check(expect, prog, flash, board, n):
+    random.seed(n)
+    data = bytearray([ random.randrange(256) for i in range(n) ])
+    data[n // 4 : n // 2] = b'\xff' * (n // 2 - n // 4)
+
+    prog.set_ctrl(ce = 1, oe = 1, we = 1)
+    expect('software id', prog.software_id() == 0xbfb6)
+
+    prog.chip_erase()
+    expect('chip erase', prog.read_block(0, n) == b'\xff' * n)
+
+    bad = prog.program_block(0, data, sparse = True)
+    expect('program', not bad)
+    expect('flash contents', bytes(flash.mem[:n]) == bytes(data))
+    expect('read back', prog.read_block(0, n) == bytes(data))
+
+    prog.sector_erase(Prog.SECTOR_SIZE)
+    expect('sector erase', bytes(flash.mem[Prog.SECTOR_SIZE : 2 * Prog.SECTOR_SIZE])
+           == b'\xff' * Prog.SECTOR_SIZE)
+
+    # Only the sectors which differ from the flash should be erased,
+    # the one erased above (if it held data) and the one with the
+    # last byte
+    data[n - 1] ^= 0xff
+    size = Prog.SECTOR_SIZE
+    padded = bytes(data) + b'\xff' * (-n % size)
+    changed = [ addr for addr in range(0, len(padded), size)
+                if bytes(flash.mem[addr : addr + size]) != padded[addr : addr + size] ]
+    erased, bad = prog.program_diff(0, data)
+    expect('diff', not bad and bytes(flash.mem[:n]) == bytes(data)
+           and erased == changed)
+
+    expect('no bus contention', not board.contention)
+
+def check_batch(expect, prog, flash, n):
+    try:
+        import numpy
+    except ImportError:
+        print("%-24s %s" % ('batch encoder', "skipped, no NumPy"))
+        return
+
+    enc = prog.get_encoder()
+    state = prog.state
+    rng = random.Random(n)
+    m = 256
+
+    # Tristate the data bus in some of the vectors
+    values = {
+        'addr' : [ rng.randrange(1 << 18) for i in range(m) ],
+        'data' : [ rng.choice([ -1, rng.randrange(256) ]) for i in range(m) ],
+        'ctrl' : [ rng.randrange(8) for i in range(m) ],
+        }
+    base = prog.ochain
+    expected = []
+    for i in range(m):
+        t = base
+        for name, bus in state.buses.items():
+            v = values[name][i]
+            t = bus.release(t) if v < 0 else bus.set(t, v)
+        expected.append(t)
+    vectors = enc.encode(base, values)
+    expect('batch encode', vectors == expected)
+
+    captures = [ rng.getrandbits(enc.nbits) for i in range(m) ]
+    expect('batch decode', all([
+        list(enc.decode(captures, name)) == [ state.get(name, t) for t in captures ]
+        for name in state.buses ]))
+
+    # Program m bytes in the blank sector after the data with the
+    # unlock cycles for every byte, then read them back
+    start = -(-n // Prog.SECTOR_SIZE) * Prog.SECTOR_SIZE
+    data = [ rng.randrange(256) for i in range(m) ]
+    addrs = []
+    datas = []
+    for i, d in enumerate(data):
+        addrs += [ 0x5555, 0x2aaa, 0x5555, start + i ]
+        datas += [ 0xaa, 0x55, 0xa0, d ]
+    prog.write_many(numpy.array(addrs), numpy.array(datas))
+    read = prog.read_many(numpy.arange(start, start + m))
+    # The last byte is programmed while the first ones are read
+    expect('batch write', bytes(flash.mem[start : start + m]) == bytes(data))
+    expect('batch read', bytes(read.tolist()) == bytes(data))
+
+def check_async(expect, bs, port):
+    async def read_idcode():
+        ocd = await AsyncOpenOCD(port = port, verbose = 0).connect()
+        try:
+            return await ocd.cmd_many([ bs.ir_cmd(bs.op_idcode),
+                                        bs.dr_cmd(32, 0) ])
+        finally:
+            await ocd.close()
+
+    ir, dr = asyncio.run(read_idcode())
+    # The instruction register has changed behind the back of bs
+    bs.invalidate_ir()
+    t = bs.dr_capture(32, int(dr, 16))
+    expect('async idcode', t & bs.idmask == bs.idcode & bs.idmask)
+
+def check_pipe(expect, args, n):
+    """Program and read back over a pipe to the simulator."""
+
+    sim = [ sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emu2000_sim.py'),
+            '--idcode', '0x%x' % args.idcode ]
+    if args.bsdl:
+        sim += [ '--bsdl', args.bsdl ]
+    if args.package:
+        sim += [ '--package', args.package ]
+    ocd = OpenOCD.spawn(os.devnull, sim, verbose = 0)
+    try:
+        bs = BS(ocd, 'xc.tap', args.bsdl, verbose = 0, package = args.package)
+        bs.set_speed(args.speed)
+        bs.check_idcode()
+
+        prog = Prog(bs)
+        random.seed(n)
+        data = bytes([ random.randrange(256) for i in range(min(n, 1024)) ])
+        prog.set_ctrl(ce = 1, oe = 1, we = 1)
+        bad = prog.program_block(0, data)
+        expect('pipe program', not bad)
+        expect('pipe read back', prog.read_block(0, len(data)) == data)
+        prog.flush()
+        bs.bypass()
+    finally:
+        ocd.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_bsdl_args(parser)
+    parser.add_argument('--idcode', type = lambda s: int(s, 0), default = 0x09604093,
+                        help = "IDCODE used to look up the BSDL file, "
+                        "default is the XC9572XL")
+    parser.add_argument('--speed', type = int, default = 1000,
+                        help = "adapter speed in kHz")
+    parser.add_argument('-n', type = int, default = 3 * 4096,
+                        help = "number of bytes to program")
+    args = parser.parse_args()
+    if args.n < 1:
+        parser.error("-n must be at least 1")
+
+    if args.bsdl:
+        bsdl = ParsedBsdl(args.bsdl)
+    else:
+        bsdl = ParsedBsdl.from_idcode(args.idcode, args.package)
+
+    flash = Flash()
+    board = Board(bsdl, flash)
+    server = Server(board, port = 0).start()
+
+    ocd = OpenOCD(port = server.server_address[1], verbose = 0)
+    bs = BS(ocd, 'xc.tap', args.bsdl, verbose = 0, package = args.package)
+    bs.set_speed(args.speed)
+    bs.check_idcode()
+
+    errors = []
+
+    def expect(name, ok):
+        print("%-24s %s" % (name, 'ok' if ok else 'FAILED'))
+        if not ok:
+            errors.append(name)
+
+    prog = Prog(bs)
+    check(expect, prog, flash, board, args.n)
+    check_batch(expect, prog, flash, args.n)
+    check_async(expect, bs, server.server_address[1])
+
+    prog.flush()
+    bs.bypass()
+    ocd.close()
+    server.shutdown()
+
+    print("simulated time %.3f s, %u scans" % (board.now, board.scans))
+
+    check_pipe(expect, args, args.n)
+
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()